@@ -0,0 +1,279 @@
+#!/usr/bin/python3
+"""
+Benchmarks for the codec, the notification dispatch and the command round-trip against a simulated bridge.
+
+The results are written as JSON, so they can be compared between releases. The benchmark runs against the checkout
+it lives in, so pycomfoconnect doesn't need to be installed.
+
+Usage:
+  $ python3 benchmarks/benchmark.py --output results.json
+  $ python3 benchmarks/benchmark.py --only codec --compare results.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import struct
+import sys
+import time
+import timeit
+
+from google.protobuf.descriptor import FieldDescriptor
+from google.protobuf.internal import api_implementation
+
+# Benchmark the checkout we are part of, and not a version that happens to be installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pycomfoconnect import Bridge, BridgeSimulator, ComfoConnect, Dispatcher, OnChange, OVERFLOW_COALESCE, \
+    CMD_FAN_MODE_HIGH
+from pycomfoconnect import codec
+from pycomfoconnect.message import Message
+from pycomfoconnect.zehnder_pb2 import CnRmiRequest, CnRpdoNotification
+
+LOCAL_UUID = bytes.fromhex('00000000000000000000000000001337')
+BRIDGE_UUID = bytes.fromhex('0000000000251010800170b3d54264b4')
+
+# A result is flagged when it got this much worse than the baseline
+REGRESSION_THRESHOLD = 0.10
+
+results = []
+
+
+def record(group, name, value, unit, higher_is_better=False, **extra):
+    result = {
+        'group': group,
+        'name': name,
+        'value': value,
+        'unit': unit,
+        'higher_is_better': higher_is_better,
+    }
+    result.update(extra)
+    results.append(result)
+    print('%-10s %-45s %12.2f %s' % (group, name, value, unit))
+
+
+def per_call(function, min_time=0.2):
+    """Returns the time per call of a function in nanoseconds."""
+
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    number = max(number, int(number * min_time / 0.2))
+    return min(timer.repeat(repeat=5, number=number)) / number * 1e9
+
+
+# ======================================================================================================================
+# Codec
+# ======================================================================================================================
+
+def _fill_required(message):
+    """Set all required fields of a protobuf message, so it can be serialized."""
+
+    for field in message.DESCRIPTOR.fields:
+        if field.label != FieldDescriptor.LABEL_REQUIRED:
+            continue
+        if field.type == FieldDescriptor.TYPE_STRING:
+            setattr(message, field.name, 'pycomfoconnect')
+        elif field.type == FieldDescriptor.TYPE_BYTES:
+            setattr(message, field.name, bytes(range(16)))
+        elif field.type == FieldDescriptor.TYPE_BOOL:
+            setattr(message, field.name, True)
+        elif field.type == FieldDescriptor.TYPE_ENUM:
+            setattr(message, field.name, field.enum_type.values[-1].number)
+        elif field.type == FieldDescriptor.TYPE_MESSAGE:
+            _fill_required(getattr(message, field.name))
+        else:
+            setattr(message, field.name, 221)
+
+
+def sample_messages():
+    """Returns a representative message for every message type."""
+
+    messages = {}
+    for command in Message.class_to_type:
+        message = Message.create(LOCAL_UUID, BRIDGE_UUID, command, {'reference': 1234})
+        _fill_required(message.msg)
+        messages[command.__name__] = message
+
+    # Use realistic payloads for the messages we see most
+    messages['CnRpdoNotification'] = Message.create(BRIDGE_UUID, LOCAL_UUID, CnRpdoNotification, {},
+                                                    {'pdid': 221, 'data': struct.pack('<h', 215)})
+    messages['CnRmiRequest'] = Message.create(LOCAL_UUID, BRIDGE_UUID, CnRmiRequest, {'reference': 1234},
+                                              {'nodeId': 1, 'message': CMD_FAN_MODE_HIGH})
+
+    return messages
+
+
+def bench_codec():
+    for name, message in sorted(sample_messages().items()):
+        packet = message.encode()
+
+        def decode():
+            return Message.decode(packet).msg
+
+        record('codec', '%s.encode' % name, per_call(message.encode), 'ns/call', size=len(packet))
+        record('codec', '%s.decode' % name, per_call(decode), 'ns/call', size=len(packet))
+
+
+# ======================================================================================================================
+# Dispatch
+# ======================================================================================================================
+
+def bench_dispatch(count=100000):
+    sensors = [221, 274, 117, 118, 121, 122, 81, 227]
+    packets = [
+        Message.create(BRIDGE_UUID, LOCAL_UUID, CnRpdoNotification, {},
+                       {'pdid': sensors[i % len(sensors)], 'data': struct.pack('<h', i % 16)}).encode()
+        for i in range(count)
+    ]
+
+    def run(name, comfoconnect, callback=None, finish=None):
+        comfoconnect.callback_sensor = callback
+        start = time.perf_counter()
+        for packet in packets:
+            comfoconnect._handle_rpdo_notification(Message.decode(packet))
+        if finish:
+            finish()
+        elapsed = time.perf_counter() - start
+        record('dispatch', name, count / elapsed, 'notifications/s', higher_is_better=True)
+
+    run('no_callback', ComfoConnect(Bridge('127.0.0.1', BRIDGE_UUID)))
+    run('callback', ComfoConnect(Bridge('127.0.0.1', BRIDGE_UUID)), lambda pdid, value: None)
+
+    comfoconnect = ComfoConnect(Bridge('127.0.0.1', BRIDGE_UUID))
+    for sensor in sensors:
+        comfoconnect.set_policy(sensor, OnChange())
+    run('callback_on_change', comfoconnect, lambda pdid, value: None)
+
+    dispatcher = Dispatcher(workers=2, maxsize=count)
+    run('callback_dispatcher', ComfoConnect(Bridge('127.0.0.1', BRIDGE_UUID), dispatcher=dispatcher),
+        lambda pdid, value: None, dispatcher.close)
+
+    dispatcher = Dispatcher(workers=1, maxsize=100, overflow=OVERFLOW_COALESCE)
+    run('callback_dispatcher_coalesce', ComfoConnect(Bridge('127.0.0.1', BRIDGE_UUID), dispatcher=dispatcher),
+        lambda pdid, value: None, dispatcher.close)
+
+
+# ======================================================================================================================
+# End-to-end
+# ======================================================================================================================
+
+def _percentile(samples, percentile):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * percentile))]
+
+
+def bench_roundtrip(count=2000, latency=0):
+    simulator = BridgeSimulator(host='127.0.0.1', port=0, rate=None, latency=latency, discovery=False)
+    simulator.start_background()
+
+    try:
+        comfoconnect = ComfoConnect(Bridge('127.0.0.1', simulator.uuid, simulator.port))
+        comfoconnect.connect()
+
+        try:
+            # Sequential requests
+            samples = []
+            for _ in range(count):
+                start = time.perf_counter()
+                comfoconnect.cmd_time_request()
+                samples.append((time.perf_counter() - start) * 1e6)
+
+            record('roundtrip', 'time_request.mean', statistics.mean(samples), 'us')
+            record('roundtrip', 'time_request.p50', _percentile(samples, 0.50), 'us')
+            record('roundtrip', 'time_request.p99', _percentile(samples, 0.99), 'us')
+
+            # Pipelined requests
+            start = time.perf_counter()
+            for _ in range(count // 100):
+                comfoconnect.cmd_rmi_request_batch([CMD_FAN_MODE_HIGH] * 100)
+            elapsed = time.perf_counter() - start
+            record('roundtrip', 'rmi_request_batch', count / elapsed, 'requests/s', higher_is_better=True)
+
+        finally:
+            comfoconnect.disconnect()
+
+        # Notifications from the simulator to the callback
+        simulator.rate = 2000
+        comfoconnect = ComfoConnect(Bridge('127.0.0.1', simulator.uuid, simulator.port))
+        received = [0]
+
+        def callback(pdid, value):
+            received[0] += 1
+
+        comfoconnect.callback_sensor = callback
+        comfoconnect.connect()
+        try:
+            comfoconnect.register_sensors([221, 274, 117, 118, 121])
+            start_count, start = received[0], time.perf_counter()
+            time.sleep(2)
+            elapsed = time.perf_counter() - start
+            record('roundtrip', 'notifications', (received[0] - start_count) / elapsed, 'notifications/s',
+                   higher_is_better=True, offered=simulator.rate * 5)
+        finally:
+            comfoconnect.disconnect()
+
+    finally:
+        simulator.stop_background()
+
+
+# ======================================================================================================================
+# Reporting
+# ======================================================================================================================
+
+def compare(baseline_path):
+    """Print the results that got worse compared to a previous run, and return how many there are."""
+
+    with open(baseline_path) as file:
+        baseline = {(result['group'], result['name']): result for result in json.load(file)['results']}
+
+    regressions = 0
+    for result in results:
+        previous = baseline.get((result['group'], result['name']))
+        if previous is None or not previous['value']:
+            continue
+
+        change = result['value'] / previous['value'] - 1
+        worse = -change if result['higher_is_better'] else change
+        if worse > REGRESSION_THRESHOLD:
+            regressions += 1
+            print('REGRESSION %s %s: %.2f -> %.2f %s (%+.0f%%)' % (
+                result['group'], result['name'], previous['value'], result['value'], result['unit'], change * 100
+            ))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark pycomfoconnect.')
+    parser.add_argument('--only', choices=['codec', 'dispatch', 'roundtrip'], action='append',
+                        help='only run these benchmarks')
+    parser.add_argument('--output', '-o', help='write the results to this JSON file')
+    parser.add_argument('--compare', '-c', help='compare with the results in this JSON file')
+    args = parser.parse_args()
+
+    groups = args.only or ['codec', 'dispatch', 'roundtrip']
+    if 'codec' in groups:
+        bench_codec()
+    if 'dispatch' in groups:
+        bench_dispatch()
+    if 'roundtrip' in groups:
+        bench_roundtrip()
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({
+                'timestamp': time.time(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'protobuf': api_implementation.Type(),
+                'codec': codec.ENABLED,
+                'results': results,
+            }, file, indent=2)
+
+    if args.compare and compare(args.compare):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
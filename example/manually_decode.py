@@ -1,67 +1,35 @@
 #!/usr/bin/python3
-import struct
 import sys
+import tempfile
 
-import pycomfoconnect
-from pycomfoconnect import zehnder_pb2
+from pycomfoconnect import decoder
 
 """
 Pipe the messages to this programm to decode them. If they are stored in HEX, you should pass them to xxd -r -p first.
 You can combine both input and output streams.
 
+This is a thin wrapper around `python3 -m pycomfoconnect.decoder`, which can also decode capture files directly and
+write the values of every sensor to npz or CSV files.
+
 Usage:
   $ cat captures/raw_*.txt | xxd -r -p | ./manually_decode.py
 """
 
-pdids = {}
-rmis = {}
-
-while True:
-
-    # Read packet from file
-    msg_len_buf = sys.stdin.buffer.read(4)
-    if not msg_len_buf:
-        break
-    msg_len = struct.unpack('>L', msg_len_buf)[0]
-    msg_buf = sys.stdin.buffer.read(msg_len)
-
-    # Decode packet
-    message = pycomfoconnect.Message.decode(msg_len_buf + msg_buf)
-
-    if message.cmd.type == zehnder_pb2.GatewayOperation.CnRmiRequestType:
-        if not message.cmd.reference in rmis:
-            rmis[message.cmd.reference] = {}
-        rmis[message.cmd.reference]['tx'] = message.msg.message.hex()
-
-    if message.cmd.type == zehnder_pb2.GatewayOperation.CnRmiResponseType:
-        if not message.cmd.reference in rmis:
-            rmis[message.cmd.reference] = {}
-        rmis[message.cmd.reference]['rx'] = message.msg.message.hex()
-
-    if message.cmd.type == zehnder_pb2.GatewayOperation.CnRpdoRequestType:
-        if not message.msg.pdid in pdids:
-            pdids[message.msg.pdid] = {}
-        try:
-            pdids[message.msg.pdid]['tx'].append(message.msg.type)
-        except KeyError:
-            pdids[message.msg.pdid]['tx'] = [message.msg.type]
+# The decoder memory-maps its input, so we store the stream in a file first
+with tempfile.NamedTemporaryFile() as capture:
+    while True:
+        chunk = sys.stdin.buffer.read(1024 * 1024)
+        if not chunk:
+            break
+        capture.write(chunk)
+    capture.flush()
 
-    if message.cmd.type == zehnder_pb2.GatewayOperation.CnRpdoConfirmType:
-        pass
+    sensors, rmis = decoder.decode_capture(capture.name)
 
-    if message.cmd.type == zehnder_pb2.GatewayOperation.CnRpdoNotificationType:
-        if not message.msg.pdid in pdids:
-            pdids[message.msg.pdid] = {}
-        try:
-            pdids[message.msg.pdid]['rx'].append(message.msg.data.hex())
-        except KeyError:
-            pdids[message.msg.pdid]['rx'] = [message.msg.data.hex()]
+print("CnRpdoNotificationType")
+for pdid, (timestamps, values) in sorted(sensors.items()):
+    print(pdid, values.tolist())
 
-print("CnRpdoRequestType")
-for pdid in pdids:
-    print(pdid, pdids[pdid])
-#
-# # print("CnRmiRequestType")
-# # for rmi in rmis:
-# #     print(rmi, rmis[rmi])
-#
+print("CnRmiRequestType")
+for rmi in rmis:
+    print(rmi['reference'], {'tx': rmi['request'], 'rx': rmi['response']})
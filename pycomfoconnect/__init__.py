@@ -9,5 +9,18 @@ DEFAULT_PIN = 0
 __author__ = 'Michaël Arnauts <michael.arnauts@gmail.com>'
 
 from .comfoconnect import *
+from .aiobridge import AsyncBridge
+from .aiocomfoconnect import AsyncComfoConnect
+from .capture import CaptureWriter, CaptureReader, ReplayBridge
+from .discovery import DiscoveryCache, discover, iter_discover, async_discover, aiter_discover
+from .dispatch import Dispatcher, OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_COALESCE
+from .fleet import BridgePool, TimerWheel
+from .history import SensorHistory
+from .metrics import MetricsSink, InMemoryMetrics
+from .policy import DispatchPolicy, OnChange, Deadband, MinInterval
+from .reconnect import ReconnectStrategy
+from .recorder import NotificationLog, LogReader
+from .simulator import BridgeSimulator
+from .subscription import Subscription
 from .error import *
 from .const import *
\ No newline at end of file
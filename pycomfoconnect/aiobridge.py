@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import socket
+import struct
+import time
+
+from .bridge import Bridge
+from .message import *
+from .metrics import operation_name
+
+_LOGGER = logging.getLogger('aiobridge')
+
+
+class _DiscoveryProtocol(asyncio.DatagramProtocol):
+    """Collects the responses to a discovery broadcast."""
+
+    def __init__(self, host=None, port=Bridge.PORT):
+        self._host = host
+        self._port = port
+        self.bridges = []
+        self.done = asyncio.Event()
+
+    def datagram_received(self, data, addr):
+        # Parse data
+        parser = DiscoveryOperation()
+        parser.ParseFromString(data)
+
+        # Add a new Bridge to the list
+        self.bridges.append(
+            AsyncBridge(parser.searchGatewayResponse.ipaddress, parser.searchGatewayResponse.uuid, self._port)
+        )
+
+        # Don't look for other bridges if we directly discovered it by IP
+        if self._host:
+            self.done.set()
+
+
+class AsyncBridge(object):
+    """Implements an asyncio interface to send and receive messages from the Bridge."""
+
+    PORT = Bridge.PORT
+
+    @staticmethod
+    async def discover(host=None, timeout=5, port=PORT):
+        """Broadcast the network and look for local bridges."""
+
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.create_datagram_endpoint(
+            lambda: _DiscoveryProtocol(host, port),
+            family=socket.AF_INET,
+            allow_broadcast=True
+        )
+
+        try:
+            # Send broadcast packet
+            transport.sendto(b"\x0a\x00", (host or '<broadcast>', port))
+
+            # Wait for the responses
+            try:
+                await asyncio.wait_for(protocol.done.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        finally:
+            transport.close()
+
+        # Return found bridges
+        return protocol.bridges
+
+    def __init__(self, host: str, uuid: str, port: int = PORT) -> None:
+        self.host = host
+        self.uuid = uuid
+        self.port = port
+
+        self._reader = None
+        self._writer = None
+        self.debug = False
+
+        # Optional CaptureWriter that records all frames
+        self.capture = None
+
+        # Optional MetricsSink that counts the frames
+        self.metrics = None
+
+        # Monotonic time when we last sent and received data
+        self.last_tx = None
+        self.last_rx = None
+
+    async def connect(self) -> bool:
+        """Open connection to the bridge."""
+
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+            self.last_tx = self.last_rx = time.monotonic()
+
+        return True
+
+    async def disconnect(self) -> bool:
+        """Close connection to the bridge."""
+
+        if self._writer is not None:
+            writer = self._writer
+            self._reader = None
+            self._writer = None
+
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+        return True
+
+    def is_connected(self):
+        """Returns weather there is an open connection."""
+
+        return self._writer is not None
+
+    async def read_message(self) -> Message:
+        """Wait for the next message from the connection."""
+
+        if self._reader is None:
+            raise BrokenPipeError()
+
+        try:
+            # Read packet size
+            msg_len_buf = await self._reader.readexactly(4)
+
+            # Read rest of packet
+            msg_len = struct.unpack('>L', msg_len_buf)[0]
+            msg_buf = await self._reader.readexactly(msg_len)
+
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # No data, but there has to be.
+            raise BrokenPipeError()
+
+        self.last_rx = time.monotonic()
+        packet = msg_len_buf + msg_buf
+        if self.capture is not None:
+            self.capture.record_rx(packet)
+
+        # Decode message
+        message = Message.decode(packet)
+
+        if self.metrics is not None:
+            labels = {'type': operation_name(message.cmd.type)}
+            self.metrics.increment('comfoconnect_frames_received_total', labels=labels)
+            self.metrics.increment('comfoconnect_bytes_received_total', len(packet), labels=labels)
+
+        # Debug message
+        _LOGGER.debug("RX %s", message)
+
+        return message
+
+    async def write_message(self, message: Message) -> bool:
+        """Send a message."""
+
+        if self._writer is None:
+            raise Exception('Not connected!')
+
+        # Construct packet
+        packet = message.encode()
+
+        # Debug message
+        _LOGGER.debug("TX %s", message)
+
+        if self.capture is not None:
+            self.capture.record_tx(packet)
+
+        if self.metrics is not None:
+            labels = {'type': operation_name(message.cmd.type)}
+            self.metrics.increment('comfoconnect_frames_sent_total', labels=labels)
+            self.metrics.increment('comfoconnect_bytes_sent_total', len(packet), labels=labels)
+
+        # Send packet
+        try:
+            self._writer.write(packet)
+            await self._writer.drain()
+        except ConnectionError:
+            await self.disconnect()
+            return False
+
+        self.last_tx = time.monotonic()
+        return True
@@ -0,0 +1,524 @@
+import asyncio
+import logging
+import time
+
+from .aiobridge import AsyncBridge
+from .comfoconnect import KEEPALIVE, DEAD_PEER_TIMEOUT, DEFAULT_LOCAL_UUID, DEFAULT_LOCAL_DEVICENAME, DEFAULT_PIN, \
+    RPDO_TYPE_MAP, PRODUCT_ID_MAP, check_result, decode_rpdo_value
+from .error import *
+from .message import Message
+from .state import SensorStateCache
+from .zehnder_pb2 import *
+
+_LOGGER = logging.getLogger('aiocomfoconnect')
+
+# Number of sensor updates we keep for a notifications iterator that can't keep up. The oldest ones are dropped first.
+NOTIFICATION_QUEUE_SIZE = 1024
+
+
+def put_latest(queue: asyncio.Queue, item):
+    """Queue an item, and drop the oldest item when the queue is full."""
+
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(item)
+
+
+class AsyncComfoConnect(object):
+    """Implements the commands to communicate with the ComfoConnect ventilation unit on top of asyncio."""
+
+    def __init__(self, bridge: AsyncBridge, local_uuid=DEFAULT_LOCAL_UUID, local_devicename=DEFAULT_LOCAL_DEVICENAME,
+                 pin=DEFAULT_PIN, keepalive: float = KEEPALIVE, dead_peer_timeout: float = DEAD_PEER_TIMEOUT):
+        self._bridge = bridge
+        self._local_uuid = local_uuid
+        self._local_devicename = local_devicename
+        self._pin = pin
+        self._reference = 1
+
+        self._replies = {}
+
+        # The queue of every notifications iterator
+        self._consumers = set()
+        self._read_task = None
+        self._keepalive_task = None
+
+        # Keepalives, probes and disconnects that run in the background
+        self._tasks = set()
+
+        # How long the connection can be idle before we send a keepalive, or before we consider it dead
+        self.keepalive = keepalive
+        self.dead_peer_timeout = dead_peer_timeout
+        self._next_probe = 0
+
+        self.sensors = {}
+
+        # Latest value of every sensor
+        self.state = SensorStateCache()
+
+    # ==================================================================================================================
+    # Core functions
+    # ==================================================================================================================
+
+    async def connect(self, takeover=False):
+        """Connect to the bridge and login. Disconnect existing clients if needed by default."""
+
+        try:
+            # Connect to the bridge
+            await self._bridge.connect()
+            self._read_task = asyncio.ensure_future(self._read_loop())
+
+            try:
+                # Login
+                await self.cmd_start_session(takeover)
+
+            except PyComfoConnectNotAllowed:
+                # No dice, maybe we are not registered yet...
+                await self.cmd_register_app(self._local_uuid, self._local_devicename, self._pin)
+                await self.cmd_start_session(takeover)
+
+        except PyComfoConnectNotAllowed:
+            await self._close()
+            raise Exception('Could not connect to the bridge since the PIN seems to be invalid.')
+
+        except PyComfoConnectOtherSession:
+            await self._close()
+            raise Exception('Could not connect to the bridge since there is already an open session.')
+
+        except Exception as exc:
+            _LOGGER.error(exc)
+            await self._close()
+            raise Exception('Could not connect to the bridge.')
+
+        # Start sending keepalives
+        self._start_keepalive()
+
+        # Re-register for sensor updates
+        await self.register_sensors(list(self.sensors.items()))
+
+        return True
+
+    async def disconnect(self):
+        """Disconnect from the bridge."""
+
+        if self.is_connected():
+            try:
+                await self.cmd_close_session()
+            except (BrokenPipeError, ValueError, PyComfoConnectError):
+                pass
+
+        await self._close()
+
+    def is_connected(self):
+        """Returns whether there is a connection with the bridge."""
+
+        return self._bridge.is_connected()
+
+    async def register_sensor(self, sensor_id: int, sensor_type: int = None):
+        """Register a sensor on the bridge and keep it in memory that we are registered to this sensor."""
+
+        if not sensor_type:
+            sensor_type = RPDO_TYPE_MAP.get(sensor_id)
+
+        if sensor_type is None:
+            raise Exception("Registering sensor %d with unknown type" % sensor_id)
+
+        # Register on bridge
+        try:
+            reply = await self.cmd_rpdo_request(sensor_id, sensor_type)
+
+        except PyComfoConnectNotAllowed:
+            return None
+
+        # Register in memory
+        self.sensors[sensor_id] = sensor_type
+
+        return reply
+
+    async def register_sensors(self, sensors):
+        """Register multiple sensors on the bridge at once and return a dict with the success for each sensor.
+
+        The sensors can be given as sensor ids or as (sensor_id, sensor_type) tuples."""
+
+        # Resolve the types first, so we don't register half of the list
+        sensor_types = {}
+        for sensor in sensors:
+            if isinstance(sensor, tuple):
+                sensor_id, sensor_type = sensor
+            else:
+                sensor_id, sensor_type = sensor, None
+
+            if not sensor_type:
+                sensor_type = RPDO_TYPE_MAP.get(sensor_id)
+
+            if sensor_type is None:
+                raise Exception("Registering sensor %d with unknown type" % sensor_id)
+
+            sensor_types[sensor_id] = sensor_type
+
+        # Send all requests to the bridge and collect the confirms
+        replies = await asyncio.gather(
+            *(self.cmd_rpdo_request(sensor_id, sensor_type) for sensor_id, sensor_type in sensor_types.items()),
+            return_exceptions=True
+        )
+
+        results = {}
+        for (sensor_id, sensor_type), reply in zip(sensor_types.items(), replies):
+            if isinstance(reply, Exception):
+                _LOGGER.warning('Could not register sensor %d: %s', sensor_id, reply.__class__.__name__)
+                results[sensor_id] = False
+                continue
+
+            # Register in memory
+            self.sensors[sensor_id] = sensor_type
+            results[sensor_id] = True
+
+        return results
+
+    async def unregister_sensor(self, sensor_id: int, sensor_type: int = None):
+        """Unregister a sensor on the bridge and remove it from memory."""
+
+        if sensor_type is None:
+            sensor_type = RPDO_TYPE_MAP.get(sensor_id)
+
+        if sensor_type is None:
+            raise Exception("Unregistering sensor %d with unknown type" % sensor_id)
+
+        # Unregister in memory
+        self.sensors.pop(sensor_id, None)
+
+        # Unregister on bridge
+        await self.cmd_rpdo_request(sensor_id, sensor_type, timeout=0)
+
+    async def notifications(self):
+        """Iterate over the sensor updates as (sensor_id, value) tuples until the connection is closed.
+
+        Every iterator gets all updates, that are only queued while it is iterating."""
+
+        queue = asyncio.Queue(NOTIFICATION_QUEUE_SIZE)
+        self._consumers.add(queue)
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                yield item
+        finally:
+            self._consumers.discard(queue)
+
+    async def _command(self, command, params=None, timeout=5):
+        """Sends a command and wait for a response if the request is known to return a result."""
+
+        reference = self._reference
+        self._reference += 1
+
+        # Construct the message
+        message = Message.create(
+            self._local_uuid,
+            self._bridge.uuid,
+            command,
+            {'reference': reference},
+            params
+        )
+
+        # Check if this command has a confirm type set
+        if command not in Message.class_to_confirm:
+            await self._bridge.write_message(message)
+            return None
+
+        # Register the reply before sending, so the read loop can never miss it
+        future = asyncio.get_running_loop().create_future()
+        self._replies[reference] = future
+
+        try:
+            # Send the message
+            await self._bridge.write_message(message)
+
+            # Wait for the reply
+            return await self._wait_reply(future, timeout)
+
+        finally:
+            self._replies.pop(reference, None)
+
+    async def _wait_reply(self, future, timeout):
+        """Wait until the reply has arrived."""
+
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise ValueError('Timeout waiting for response.')
+
+    async def _close(self):
+        """Stop the background tasks and close the connection."""
+
+        for task in (self._keepalive_task, self._read_task):
+            if task is not None and task is not asyncio.current_task():
+                task.cancel()
+                try:
+                    await task
+                except (asyncio.CancelledError, Exception):
+                    pass
+
+        self._keepalive_task = None
+        self._read_task = None
+
+        await self._bridge.disconnect()
+
+    # ==================================================================================================================
+    # Background tasks
+    # ==================================================================================================================
+
+    def _start_keepalive(self):
+        """Start sending keepalives in the background."""
+
+        self._next_probe = 0
+        self._keepalive_task = asyncio.ensure_future(self._keepalive_loop())
+
+    async def _keepalive_loop(self):
+        """Sends a keepalive when the connection was idle, and closes it when the bridge doesn't respond anymore."""
+
+        while True:
+            wait = self._check_idle()
+            if wait is None:
+                return
+            await asyncio.sleep(wait)
+
+    def _check_idle(self):
+        """Send a keepalive or a probe when the connection has been idle.
+
+        Returns the seconds until we need to check again, or None when the bridge doesn't respond anymore. In that
+        case the connection is closed, which ends the read loop."""
+
+        now = time.monotonic()
+
+        # Only send a keepalive when we didn't send anything else for a while
+        tx_idle = now - (self._bridge.last_tx or 0)
+        if tx_idle >= self.keepalive:
+            self._spawn(self._send_keepalive())
+            tx_idle = 0
+        wait = self.keepalive - tx_idle
+
+        if self.dead_peer_timeout:
+            rx_idle = now - (self._bridge.last_rx or now)
+            if rx_idle >= self.dead_peer_timeout:
+                _LOGGER.warning('The bridge did not respond for %.0f seconds.', rx_idle)
+                self._spawn(self._bridge.disconnect())
+                return None
+
+            # Ask the bridge for a reply when it has been quiet for a while
+            interval = self.dead_peer_timeout / 3
+            if rx_idle >= interval and now >= self._next_probe:
+                self._next_probe = now + interval
+                self._spawn(self._probe())
+
+            wait = min(wait, self.dead_peer_timeout - rx_idle, interval if rx_idle >= interval else interval - rx_idle)
+
+        return wait
+
+    def _spawn(self, coroutine):
+        """Run a coroutine in the background, and keep a reference to its task until it's done."""
+
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send_keepalive(self):
+        try:
+            await self.cmd_keepalive()
+        except Exception as exc:
+            _LOGGER.debug('Could not send keepalive: %s', exc)
+
+    async def _probe(self):
+        """Send a request that the bridge has to answer."""
+
+        try:
+            await self.cmd_time_request()
+        except Exception as exc:
+            _LOGGER.debug('The bridge did not answer the probe: %s', exc)
+
+    async def _read_loop(self):
+        """Listen for incoming messages and resolve the pending replies or queue notifications."""
+
+        try:
+            while True:
+                try:
+                    # Read a message from the bridge.
+                    message = await self._bridge.read_message()
+
+                except BrokenPipeError:
+                    _LOGGER.warning('The connection was broken.')
+                    break
+
+                if message.cmd.type == GatewayOperation.CnRpdoNotificationType:
+                    self._handle_rpdo_notification(message)
+
+                elif message.cmd.type == GatewayOperation.GatewayNotificationType:
+                    _LOGGER.info('Unhandled GatewayNotificationType')
+
+                elif message.cmd.type == GatewayOperation.CnNodeNotificationType:
+                    _LOGGER.info('CnNodeNotificationType: %s @ Node Id %d [%s]',
+                                 PRODUCT_ID_MAP[message.msg.productId],
+                                 message.msg.nodeId,
+                                 message.msg.NodeModeType.Name(message.msg.mode))
+
+                elif message.cmd.type == GatewayOperation.CnAlarmNotificationType:
+                    _LOGGER.info('Unhandled CnAlarmNotificationType')
+
+                elif message.cmd.type == GatewayOperation.CloseSessionRequestType:
+                    _LOGGER.info('The Bridge has asked us to close the connection.')
+                    break
+
+                else:
+                    self._handle_reply(message)
+
+        finally:
+            # Wake up everybody that is still waiting on us
+            for future in self._replies.values():
+                if not future.done():
+                    future.set_exception(BrokenPipeError())
+            for queue in self._consumers:
+                put_latest(queue, None)
+
+            if self._keepalive_task is not None:
+                self._keepalive_task.cancel()
+            await self._bridge.disconnect()
+
+    def _handle_reply(self, message):
+        """Resolve the command that is waiting for this reply."""
+
+        future = self._replies.get(message.cmd.reference)
+        if future is None or future.done():
+            _LOGGER.debug('Dropping unexpected reply with reference %d', message.cmd.reference)
+            return
+
+        try:
+            check_result(message)
+        except PyComfoConnectError as exc:
+            future.set_exception(exc)
+        else:
+            future.set_result(message)
+
+    def _handle_rpdo_notification(self, message):
+        """Update internal sensor state and queue the update for the notifications iterator."""
+
+        val = decode_rpdo_value(message.msg.pdid, message.msg.data)
+        self.state.update(message.msg.pdid, val, time.time())
+        for queue in self._consumers:
+            put_latest(queue, (message.msg.pdid, val))
+
+    # ==================================================================================================================
+    # Commands
+    # ==================================================================================================================
+
+    async def cmd_start_session(self, take_over=False):
+        """Starts the session on the device by logging in and optionally disconnecting an already existing session."""
+
+        reply = await self._command(
+            StartSessionRequest,
+            {
+                'takeover': take_over
+            }
+        )
+        return reply  # TODO: parse output
+
+    async def cmd_close_session(self):
+        """Stops the current session."""
+
+        reply = await self._command(
+            CloseSessionRequest
+        )
+        return reply  # TODO: parse output
+
+    async def cmd_list_registered_apps(self):
+        """Returns a list of all the registered clients."""
+
+        reply = await self._command(
+            ListRegisteredAppsRequest
+        )
+        return [
+            {'uuid': app.uuid, 'devicename': app.devicename} for app in reply.msg.apps
+        ]
+
+    async def cmd_register_app(self, uuid, device_name, pin):
+        """Register a new app by specifying our own uuid, device_name and pin code."""
+
+        reply = await self._command(
+            RegisterAppRequest,
+            {
+                'uuid': uuid,
+                'devicename': device_name,
+                'pin': pin,
+            }
+        )
+        return reply  # TODO: parse output
+
+    async def cmd_deregister_app(self, uuid):
+        """Remove the specified app from the registration list."""
+
+        if uuid == self._local_uuid:
+            raise Exception('You should not deregister yourself.')
+
+        try:
+            await self._command(
+                DeregisterAppRequest,
+                {
+                    'uuid': uuid
+                }
+            )
+            return True
+
+        except PyComfoConnectBadRequest:
+            return False
+
+    async def cmd_version_request(self):
+        """Returns version information."""
+
+        reply = await self._command(
+            VersionRequest
+        )
+        return {
+            'gatewayVersion': reply.msg.gatewayVersion,
+            'serialNumber': reply.msg.serialNumber,
+            'comfoNetVersion': reply.msg.comfoNetVersion,
+        }
+
+    async def cmd_time_request(self):
+        """Returns the current time on the device."""
+
+        reply = await self._command(
+            CnTimeRequest
+        )
+        return reply.msg.currentTime
+
+    async def cmd_rmi_request(self, message, node_id: int = 1):
+        """Sends a RMI request."""
+
+        await self._command(
+            CnRmiRequest,
+            {
+                'nodeId': node_id or 1,
+                'message': message
+            }
+        )
+        return True
+
+    async def cmd_rpdo_request(self, pdid: int, type: int = 1, zone: int = 1, timeout=None):
+        """Register a RPDO request."""
+
+        reply = await self._command(
+            CnRpdoRequest,
+            {
+                'pdid': pdid,
+                'type': type,
+                'zone': zone or 1,
+                'timeout': timeout
+            }
+        )
+        return reply
+
+    async def cmd_keepalive(self):
+        """Sends a keepalive."""
+
+        await self._command(
+            KeepAlive
+        )
+        return True
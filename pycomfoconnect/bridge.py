@@ -1,11 +1,17 @@
+import collections
 import logging
 import select
 import socket
+import time
 
 from .message import *
+from .metrics import operation_name
 
 _LOGGER = logging.getLogger('bridge')
 
+# Initial size of the receive buffer
+RECV_BUFFER_SIZE = 65536
+
 
 class Bridge(object):
     """Implements an interface to send and receive messages from the Bridge."""
@@ -13,7 +19,7 @@ class Bridge(object):
     PORT = 56747
 
     @staticmethod
-    def discover(host=None, timeout=5):
+    def discover(host=None, timeout=5, port=PORT):
         """Broadcast the network and look for local bridges."""
 
         # Setup socket
@@ -23,15 +29,16 @@ class Bridge(object):
 
         # Send broadcast packet
         if host is None:
-            udpsocket.sendto(b"\x0a\x00", ('<broadcast>', Bridge.PORT))
+            udpsocket.sendto(b"\x0a\x00", ('<broadcast>', port))
         else:
-            udpsocket.sendto(b"\x0a\x00", (host, Bridge.PORT))
+            udpsocket.sendto(b"\x0a\x00", (host, port))
 
-        # Try to read response
+        # Try to read response until the timeout has passed, no matter how many bridges respond
+        deadline = time.monotonic() + timeout
         parser = DiscoveryOperation()
         bridges = []
         while True:
-            ready = select.select([udpsocket], [], [], timeout)
+            ready = select.select([udpsocket], [], [], max(deadline - time.monotonic(), 0))
             if not ready[0]:
                 break
 
@@ -44,7 +51,7 @@ class Bridge(object):
 
             # Add a new Bridge to the list
             bridges.append(
-                Bridge(ip_address, uuid)
+                Bridge(ip_address, uuid, port)
             )
 
             # Don't look for other bridges if we directly discovered it by IP
@@ -56,30 +63,60 @@ class Bridge(object):
         # Return found bridges
         return bridges
 
-    def __init__(self, host: str, uuid: str) -> None:
+    def __init__(self, host: str, uuid: str, port: int = PORT) -> None:
         self.host = host
         self.uuid = uuid
+        self.port = port
 
         self._socket = None
         self.debug = False
 
-    def connect(self) -> bool:
-        """Open connection to the bridge."""
+        # Optional CaptureWriter that records all frames
+        self.capture = None
+
+        # Optional MetricsSink that counts the frames
+        self.metrics = None
+
+        # Monotonic time when we last sent and received data
+        self.last_tx = None
+        self.last_rx = None
+
+        # Receive buffer and the messages we have decoded from it but didn't return yet
+        self._rx_buffer = bytearray(RECV_BUFFER_SIZE)
+        self._rx_view = memoryview(self._rx_buffer)
+        self._rx_length = 0
+        self._rx_messages = collections.deque()
+
+    def connect(self, timeout: float = None) -> bool:
+        """Open connection to the bridge. The timeout only applies to opening the connection."""
 
         if self._socket is None:
             tcpsocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            tcpsocket.connect((self.host, Bridge.PORT))
+            tcpsocket.settimeout(timeout)
+            try:
+                tcpsocket.connect((self.host, self.port))
+            except OSError:
+                tcpsocket.close()
+                raise
+            self.last_tx = self.last_rx = time.monotonic()
             tcpsocket.setblocking(0)
             self._socket = tcpsocket
 
         return True
 
     def disconnect(self) -> bool:
-        """Close connection to the bridge."""
+        """Close connection to the bridge. Does nothing when the connection is already closed."""
+
+        if self._socket is None:
+            return True
 
         self._socket.close()
         self._socket = None
 
+        # Drop whatever was left in the buffers
+        self._rx_length = 0
+        self._rx_messages.clear()
+
         return True
 
     def is_connected(self):
@@ -90,35 +127,106 @@ class Bridge(object):
     def read_message(self, timeout=1) -> Message:
         """Read a message from the connection."""
 
+        if not self._rx_messages:
+            self._rx_messages.extend(self._receive(timeout))
+
+        if not self._rx_messages:
+            # Timeout
+            return None
+
+        return self._rx_messages.popleft()
+
+    def read_messages(self, timeout=1) -> list:
+        """Read all complete messages that are available on the connection."""
+
+        if self._rx_messages:
+            messages = list(self._rx_messages)
+            self._rx_messages.clear()
+            return messages
+
+        return self._receive(timeout)
+
+    def _receive(self, timeout) -> list:
+        """Receive a chunk of data from the connection and return the messages that are complete."""
+
         if self._socket is None:
-            raise BrokenPipeError()
+            raise BrokenPipeError('not connected')
 
         # Check if there is data available
         ready = select.select([self._socket], [], [], timeout)
         if not ready[0]:
             # Timeout
-            return None
+            return []
 
-        # Read packet size
-        msg_len_buf = self._socket.recv(4)
-        if not msg_len_buf:
-            # No data, but there has to be.
-            raise BrokenPipeError()
+        # Grow the buffer if a single frame doesn't fit in it
+        if self._rx_length == len(self._rx_buffer):
+            buffer = bytearray(len(self._rx_buffer) * 2)
+            buffer[:self._rx_length] = self._rx_view[:self._rx_length]
+            self._rx_view.release()
+            self._rx_buffer = buffer
+            self._rx_view = memoryview(buffer)
 
-        # Read rest of packet
-        msg_len = struct.unpack('>L', msg_len_buf)[0]
-        msg_buf = self._socket.recv(msg_len)
-        if not msg_buf:
+        # Read as much as we can get
+        try:
+            received = self._socket.recv_into(self._rx_view[self._rx_length:])
+        except BlockingIOError:
+            return []
+        except ConnectionError as exc:
+            raise BrokenPipeError('the connection failed: %s' % exc)
+
+        if not received:
             # No data, but there has to be.
-            raise BrokenPipeError()
+            raise BrokenPipeError('the bridge closed the connection')
 
-        # Decode message
-        message = Message.decode(msg_len_buf + msg_buf)
+        self.last_rx = time.monotonic()
+        self._rx_length += received
 
-        # Debug message
-        _LOGGER.debug("RX %s", message)
+        # Find the boundaries of the complete frames
+        boundaries = []
+        end = 0
+        while self._rx_length - end >= 4:
+            frame_end = end + 4 + struct.unpack_from('>L', self._rx_buffer, end)[0]
+            if frame_end > self._rx_length:
+                break
+            boundaries.append(frame_end)
+            end = frame_end
+
+        if not boundaries:
+            return []
+
+        # Copy the complete frames out in one go, since the buffer will be reused for the next read
+        block = memoryview(self._rx_view[:end].tobytes())
+
+        # Keep the partial frame at the start of the buffer
+        remaining = self._rx_length - end
+        if remaining:
+            self._rx_view[:remaining] = self._rx_view[end:self._rx_length].tobytes()
+        self._rx_length = remaining
 
-        return message
+        # Decode messages
+        messages = []
+        capture = self.capture
+        metrics = self.metrics
+        start = 0
+        for frame_end in boundaries:
+            if capture is not None:
+                capture.record_rx(block[start:frame_end])
+
+            message = Message.decode(block[start:frame_end])
+
+            if metrics is not None:
+                labels = {'type': operation_name(message.cmd.type)}
+                metrics.increment('comfoconnect_frames_received_total', labels=labels)
+                metrics.increment('comfoconnect_bytes_received_total', frame_end - start, labels=labels)
+
+            start = frame_end
+
+            # Debug message
+            _LOGGER.debug("RX %s", message)
+
+            messages.append(message)
+
+        return messages
 
     def write_message(self, message: Message) -> bool:
         """Send a message."""
@@ -132,11 +240,22 @@ class Bridge(object):
         # Debug message
         _LOGGER.debug("TX %s", message)
 
+        if self.capture is not None:
+            self.capture.record_tx(packet)
+
+        if self.metrics is not None:
+            labels = {'type': operation_name(message.cmd.type)}
+            self.metrics.increment('comfoconnect_frames_sent_total', labels=labels)
+            self.metrics.increment('comfoconnect_bytes_sent_total', len(packet), labels=labels)
+
         # Send packet
         try:
             self._socket.sendall(packet)
-        except BrokenPipeError:
+        except OSError as exc:
+            # The connection was reset or broken, the reader will notice that the socket is gone
+            _LOGGER.debug('Could not send the message: %s', exc)
             self.disconnect()
             return False
 
+        self.last_tx = time.monotonic()
         return True
@@ -0,0 +1,300 @@
+import collections
+import logging
+import struct
+import threading
+import time
+
+from .bridge import Bridge
+from .message import *
+
+_LOGGER = logging.getLogger('capture')
+
+CAPTURE_MAGIC = b'CCCAPT\x00\x01'
+
+# Every frame is preceded by the monotonic time it was seen, the direction and the length of the frame
+FRAME_HEADER = struct.Struct('<dBL')
+
+DIRECTION_TX = 0
+DIRECTION_RX = 1
+
+# Messages from the bridge that we replay as they were captured
+NOTIFICATION_TYPES = (
+    GatewayOperation.GatewayNotificationType,
+    GatewayOperation.CnNodeNotificationType,
+    GatewayOperation.CnRpdoNotificationType,
+    GatewayOperation.CnAlarmNotificationType,
+    GatewayOperation.CnRmiAsyncResponseType,
+)
+
+
+class CaptureWriter(object):
+    """Writes the frames that are sent and received by a Bridge to a capture file.
+
+    Set it as the capture of a bridge to start recording: `bridge.capture = CaptureWriter('traffic.cap')`."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'wb')
+        self._file.write(CAPTURE_MAGIC)
+
+    def record_tx(self, packet, timestamp: float = None):
+        """Write a frame that was sent to the bridge."""
+
+        self._write(DIRECTION_TX, packet, timestamp)
+
+    def record_rx(self, packet, timestamp: float = None):
+        """Write a frame that was received from the bridge."""
+
+        self._write(DIRECTION_RX, packet, timestamp)
+
+    def _write(self, direction: int, packet, timestamp: float = None):
+        if timestamp is None:
+            timestamp = time.monotonic()
+
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(FRAME_HEADER.pack(timestamp, direction, len(packet)))
+            self._file.write(packet)
+
+    def flush(self):
+        """Write the buffered frames to disk."""
+
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        """Close the capture file."""
+
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class CaptureReader(object):
+    """Reads the frames of a capture file as (timestamp, direction, packet) tuples."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def __iter__(self):
+        with open(self.path, 'rb') as file:
+            if file.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+                raise Exception('%s is not a capture file' % self.path)
+
+            while True:
+                header = file.read(FRAME_HEADER.size)
+                if len(header) < FRAME_HEADER.size:
+                    # End of the capture, or a frame that was only partly written
+                    return
+
+                timestamp, direction, length = FRAME_HEADER.unpack(header)
+                packet = file.read(length)
+                if len(packet) < length:
+                    return
+
+                yield timestamp, direction, packet
+
+
+def _encode_frame(src: bytes, dst: bytes, cmd, msg_buf: bytes) -> bytes:
+    """Build a frame from a command and a message that is already serialized."""
+
+    cmd_buf = cmd.SerializeToString()
+    return struct.pack('>L', 16 + 16 + 2 + len(cmd_buf) + len(msg_buf)) + src + dst + \
+        struct.pack('>H', len(cmd_buf)) + cmd_buf + msg_buf
+
+
+def _split_frame(packet):
+    """Returns the command and the serialized message of a frame."""
+
+    cmd_len = struct.unpack_from('>H', packet, 36)[0]
+    cmd = GatewayOperation()
+    cmd.ParseFromString(bytes(packet[38:38 + cmd_len]))
+    return cmd, bytes(packet[38 + cmd_len:])
+
+
+class ReplayBridge(Bridge):
+    """Plays a capture back to a ComfoConnect instead of talking to a real bridge.
+
+    The replay starts when the first sensor is registered, since that is when the bridge starts sending
+    notifications. They are replayed with the timing of the capture divided by speed, or as fast as possible when speed
+    is None. Requests are answered with the reply that was captured for the same request, or with an empty OK
+    confirm when the capture doesn't contain one."""
+
+    def __init__(self, path: str, speed: float = 1.0, uuid: bytes = None) -> None:
+        self.speed = speed
+        self._notifications, self._replies, self._origin, captured_uuid = self._load(path)
+
+        super().__init__('replay', uuid or captured_uuid)
+
+        self.finished = threading.Event()
+        self._condition = threading.Condition()
+        self._pending = collections.deque()
+        self._position = 0
+        self._started = None
+        self._connected = False
+
+    @staticmethod
+    def _load(path: str):
+        """Split the capture in notifications and the replies to the requests we sent."""
+
+        notifications = []
+        replies = {}
+        requests = {}
+        origin = None
+        uuid = None
+
+        for timestamp, direction, packet in CaptureReader(path):
+            cmd, msg_buf = _split_frame(packet)
+
+            if direction == DIRECTION_TX:
+                requests[cmd.reference] = (cmd.type, msg_buf)
+                if origin is None and cmd.type == GatewayOperation.CnRpdoRequestType:
+                    origin = timestamp
+                continue
+
+            if uuid is None:
+                uuid = bytes(packet[4:20])
+
+            if cmd.type in NOTIFICATION_TYPES:
+                notifications.append((timestamp, packet))
+                if origin is None:
+                    origin = timestamp
+            elif cmd.reference in requests:
+                # Remember the last reply, so we can give it to the same request again
+                replies[requests.pop(cmd.reference)] = (cmd, msg_buf)
+
+        return notifications, replies, origin, uuid
+
+    def connect(self) -> bool:
+        """Start the replay."""
+
+        with self._condition:
+            if not self._connected:
+                self._connected = True
+                self._started = None
+                self._position = 0
+                self.finished.clear()
+                self.last_tx = self.last_rx = time.monotonic()
+
+        return True
+
+    def disconnect(self) -> bool:
+        """Stop the replay."""
+
+        with self._condition:
+            self._connected = False
+            self._pending.clear()
+            self._condition.notify_all()
+
+        return True
+
+    def is_connected(self):
+        """Returns whether the replay is running."""
+
+        return self._connected
+
+    def read_message(self, timeout=1) -> Message:
+        """Returns the next reply or the next notification that is due."""
+
+        messages = self._next(timeout, 1)
+        return messages[0] if messages else None
+
+    def read_messages(self, timeout=1) -> list:
+        """Returns all the replies and the notifications that are due."""
+
+        return self._next(timeout, None)
+
+    def _next(self, timeout, limit):
+        deadline = time.monotonic() + timeout
+        packets = []
+
+        with self._condition:
+            while True:
+                if not self._connected:
+                    raise BrokenPipeError('not connected')
+
+                while self._pending and (limit is None or len(packets) < limit):
+                    packets.append(self._pending.popleft())
+
+                now = time.monotonic()
+                while self._started is not None and self._position < len(self._notifications) and \
+                        (limit is None or len(packets) < limit):
+                    due = self._due(self._position)
+                    if due > now:
+                        break
+                    packets.append(self._notifications[self._position][1])
+                    self._position += 1
+
+                if self._started is not None and self._position >= len(self._notifications):
+                    self.finished.set()
+
+                if packets or now >= deadline:
+                    break
+
+                # Sleep until the next notification is due, or a reply is queued
+                wait = deadline - now
+                if self._started is not None and self._position < len(self._notifications):
+                    wait = min(wait, self._due(self._position) - now)
+                self._condition.wait(wait)
+
+        if packets:
+            self.last_rx = time.monotonic()
+
+        # Decode outside the lock, like a real bridge does after reading from the socket
+        messages = []
+        for packet in packets:
+            message = Message.decode(packet)
+            _LOGGER.debug("RX %s", message)
+            messages.append(message)
+
+        return messages
+
+    def _due(self, position):
+        """Returns the monotonic time when a notification should be replayed."""
+
+        if not self.speed:
+            return 0
+
+        return self._started + (self._notifications[position][0] - self._origin) / self.speed
+
+    def write_message(self, message: Message) -> bool:
+        """Answer a request like the bridge did in the capture."""
+
+        if not self._connected:
+            raise Exception('Not connected!')
+
+        _LOGGER.debug("TX %s", message)
+        self.last_tx = time.monotonic()
+
+        command = Message.request_type_to_class_mapping.get(message.cmd.type)
+        confirm = Message.class_to_confirm.get(command)
+        if confirm is None:
+            # This message doesn't expect a reply
+            return True
+
+        reply = self._replies.get((message.cmd.type, message.msg.SerializeToString()))
+        if reply is not None:
+            cmd, msg_buf = reply
+            cmd_copy = GatewayOperation()
+            cmd_copy.CopyFrom(cmd)
+            cmd_copy.reference = message.cmd.reference
+            packet = _encode_frame(message.dst, message.src, cmd_copy, msg_buf)
+        else:
+            packet = Message.create(
+                message.dst,
+                message.src,
+                confirm,
+                {'reference': message.cmd.reference, 'result': GatewayOperation.OK}
+            ).encode()
+
+        with self._condition:
+            if self._started is None and message.cmd.type == GatewayOperation.CnRpdoRequestType:
+                self._started = time.monotonic()
+            self._pending.append(packet)
+            self._condition.notify_all()
+
+        return True
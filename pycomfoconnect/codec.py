@@ -0,0 +1,261 @@
+"""
+Hand-written codec for the messages that make up most of the traffic.
+
+The GatewayOperation header, CnRpdoNotification and KeepAlive messages are small and have a fixed shape, so we decode
+them straight from the bytes instead of building protobuf objects. Everything that we don't recognise returns None,
+so the caller can fall back to zehnder_pb2.
+"""
+
+from google.protobuf.internal import api_implementation
+
+from .zehnder_pb2 import GatewayOperation
+
+# The decoders are several times faster than the pure-Python protobuf implementation, but the C implementations
+# parse these tiny messages just as fast, so we only use them when protobuf runs in pure Python.
+ENABLED = api_implementation.Type() == 'python'
+
+_OPERATION_TYPES = frozenset(GatewayOperation.OperationType.values())
+_GATEWAY_RESULTS = frozenset(GatewayOperation.GatewayResult.values())
+
+# Escape sequences used by the protobuf text format
+_ESCAPES = {0x0a: '\\n', 0x0d: '\\r', 0x09: '\\t', 0x22: '\\"', 0x27: "\\'", 0x5c: '\\\\'}
+
+
+def _escape(data):
+    """Escape bytes or a string the same way as the protobuf text format."""
+
+    out = ''
+    for char in data:
+        code = char if isinstance(char, int) else ord(char)
+        if code in _ESCAPES:
+            out += _ESCAPES[code]
+        elif 0x20 <= code < 0x7f or (code > 0x7f and not isinstance(char, int)):
+            out += chr(code)
+        else:
+            out += '\\%03o' % code
+    return out
+
+
+def _write_varint(value):
+    """Encode a varint."""
+
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+class GatewayHeader(object):
+    """Lightweight stand-in for the GatewayOperation protobuf message."""
+
+    __slots__ = ('type', 'result', 'resultDescription', 'reference', '_present')
+
+    def __init__(self, type=None, result=None, resultDescription=None, reference=None):
+        # Keep track of the fields that were set explicitly, so we serialize exactly like protobuf does
+        self._present = (type is not None) | (result is not None) << 1 | (resultDescription is not None) << 2 | \
+                        (reference is not None) << 3
+        self.type = type or 0
+        self.result = result or 0
+        self.resultDescription = resultDescription or ''
+        self.reference = reference or 0
+
+    def HasField(self, name):
+        return bool(self._present & _HEADER_FIELDS[name]) or bool(getattr(self, name))
+
+    def SerializeToString(self):
+        out = b''
+        if self.HasField('type'):
+            out += b'\x08' + _write_varint(self.type)
+        if self.HasField('result'):
+            out += b'\x10' + _write_varint(self.result)
+        if self.HasField('resultDescription'):
+            description = self.resultDescription.encode('utf-8')
+            out += b'\x1a' + _write_varint(len(description)) + description
+        if self.HasField('reference'):
+            out += b'\x20' + _write_varint(self.reference)
+        return out
+
+    def __str__(self):
+        out = ''
+        if self.HasField('type'):
+            out += 'type: %s\n' % GatewayOperation.OperationType.Name(self.type)
+        if self.HasField('result'):
+            out += 'result: %s\n' % GatewayOperation.GatewayResult.Name(self.result)
+        if self.HasField('resultDescription'):
+            out += 'resultDescription: "%s"\n' % _escape(self.resultDescription)
+        if self.HasField('reference'):
+            out += 'reference: %d\n' % self.reference
+        return out
+
+
+_HEADER_FIELDS = {'type': 1, 'result': 2, 'resultDescription': 4, 'reference': 8}
+
+
+class RpdoNotification(object):
+    """Lightweight stand-in for the CnRpdoNotification protobuf message."""
+
+    __slots__ = ('pdid', 'data')
+
+    def __init__(self, pdid, data):
+        self.pdid = pdid
+        self.data = data
+
+    def SerializeToString(self):
+        return b'\x08' + _write_varint(self.pdid) + b'\x12' + _write_varint(len(self.data)) + self.data
+
+    def __str__(self):
+        return 'pdid: %d\ndata: "%s"\n' % (self.pdid, _escape(self.data))
+
+
+class KeepAliveMessage(object):
+    """Lightweight stand-in for the KeepAlive protobuf message."""
+
+    __slots__ = ()
+
+    def SerializeToString(self):
+        return b''
+
+    def __str__(self):
+        return ''
+
+
+_KEEPALIVE = KeepAliveMessage()
+
+
+def decode_gateway_operation(buf):
+    """Decode a GatewayOperation header, or return None if it needs the protobuf parser."""
+
+    header = GatewayHeader.__new__(GatewayHeader)
+    header.type = 0
+    header.result = 0
+    header.resultDescription = ''
+    header.reference = 0
+    present = 0
+
+    pos = 0
+    end = len(buf)
+    try:
+        while pos < end:
+            tag = buf[pos]
+
+            # All our fields are encoded as a varint, or start with a varint length
+            value = buf[pos + 1]
+            pos += 2
+            if value & 0x80:
+                value &= 0x7f
+                shift = 7
+                while True:
+                    byte = buf[pos]
+                    pos += 1
+                    value |= (byte & 0x7f) << shift
+                    if not byte & 0x80:
+                        break
+                    shift += 7
+                    if shift >= 64:
+                        return None
+
+            if tag == 0x08:
+                if value not in _OPERATION_TYPES:
+                    return None
+                header.type = value
+                present |= 1
+            elif tag == 0x20:
+                if value > 0xffffffff:
+                    return None
+                header.reference = value
+                present |= 8
+            elif tag == 0x10:
+                if value not in _GATEWAY_RESULTS:
+                    return None
+                header.result = value
+                present |= 2
+            elif tag == 0x1a:
+                if pos + value > end:
+                    return None
+                header.resultDescription = bytes(buf[pos:pos + value]).decode('utf-8')
+                pos += value
+                present |= 4
+            else:
+                return None
+    except (IndexError, ValueError):
+        return None
+
+    header._present = present
+    return header
+
+
+def decode_rpdo_notification(buf):
+    """Decode a CnRpdoNotification, or return None if it needs the protobuf parser."""
+
+    pdid = None
+    data = None
+
+    pos = 0
+    end = len(buf)
+    try:
+        while pos < end:
+            tag = buf[pos]
+
+            # Both fields are encoded as a varint, or start with a varint length
+            value = buf[pos + 1]
+            pos += 2
+            if value & 0x80:
+                value &= 0x7f
+                shift = 7
+                while True:
+                    byte = buf[pos]
+                    pos += 1
+                    value |= (byte & 0x7f) << shift
+                    if not byte & 0x80:
+                        break
+                    shift += 7
+                    if shift >= 64:
+                        return None
+
+            if tag == 0x08:
+                if value > 0xffffffff:
+                    return None
+                pdid = value
+            elif tag == 0x12:
+                if pos + value > end:
+                    return None
+                data = bytes(buf[pos:pos + value])
+                pos += value
+            else:
+                return None
+    except (IndexError, ValueError):
+        return None
+
+    if pdid is None or data is None:
+        # Let protobuf complain about the missing required fields
+        return None
+
+    return RpdoNotification(pdid, data)
+
+
+def decode_keepalive(buf):
+    """Decode a KeepAlive, or return None if it needs the protobuf parser."""
+
+    if len(buf):
+        return None
+
+    return _KEEPALIVE
+
+
+# Message types that we can decode ourselves
+BODY_DECODERS = {
+    GatewayOperation.CnRpdoNotificationType: decode_rpdo_notification,
+    GatewayOperation.KeepAliveType: decode_keepalive,
+}
+
+
+def decode_body(cmd_type, buf):
+    """Decode the message body, or return None if it needs the protobuf parser."""
+
+    decoder = BODY_DECODERS.get(cmd_type)
+    if decoder is None:
+        return None
+
+    return decoder(buf)
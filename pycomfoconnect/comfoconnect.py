@@ -1,16 +1,35 @@
+import heapq
+import itertools
 import logging
-import queue
 import struct
 import threading
 import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 
 from .bridge import Bridge
+from .dispatch import Dispatcher
 from .error import *
+from .history import SensorHistory
 from .message import Message
+from .metrics import MetricsSink
+from .policy import DispatchPolicy
+from .reconnect import ReconnectStrategy
+from .recorder import NotificationLog
+from .sensors import SensorDefinition, TYPE_FORMATS, build_sensor_definitions
+from .state import SensorStateCache
+from .subscription import Subscription, SubscriptionRegistry
 from .zehnder_pb2 import *
 
+# Send a keepalive when we didn't send anything for this many seconds
 KEEPALIVE = 60
 
+# Consider the connection dead when we didn't receive anything for this many seconds. We ask the bridge for a reply
+# when it has been quiet for a third of this time.
+DEAD_PEER_TIMEOUT = 30
+
+# Maximum number of requests that are waiting for a reply at the same time
+MAX_IN_FLIGHT = 8
+
 DEFAULT_LOCAL_UUID = bytes.fromhex('00000000000000000000000000001337')
 DEFAULT_LOCAL_DEVICENAME = 'pycomfoconnect'
 DEFAULT_PIN = 0
@@ -96,6 +115,9 @@ RPDO_TYPE_MAP = {
     419: 0,
 }
 
+# Decoders for the known sensors
+SENSOR_DEFINITIONS = build_sensor_definitions(RPDO_TYPE_MAP)
+
 # Product ID Map
 PRODUCT_ID_MAP = {
     1: "ComfoAirQ",
@@ -110,6 +132,51 @@ PRODUCT_ID_MAP = {
     10: "Design verification test tool"
 }
 
+
+def check_result(message):
+    """Raise the matching exception when the bridge reports an error in the reply."""
+
+    if message.cmd.result == GatewayOperation.OK:
+        pass
+    elif message.cmd.result == GatewayOperation.BAD_REQUEST:
+        raise PyComfoConnectBadRequest()
+    elif message.cmd.result == GatewayOperation.INTERNAL_ERROR:
+        raise PyComfoConnectInternalError()
+    elif message.cmd.result == GatewayOperation.NOT_REACHABLE:
+        raise PyComfoConnectNotReachable()
+    elif message.cmd.result == GatewayOperation.OTHER_SESSION:
+        raise PyComfoConnectOtherSession(message.msg.devicename)
+    elif message.cmd.result == GatewayOperation.NOT_ALLOWED:
+        raise PyComfoConnectNotAllowed()
+    elif message.cmd.result == GatewayOperation.NO_RESOURCES:
+        raise PyComfoConnectNoResources()
+    elif message.cmd.result == GatewayOperation.NOT_EXIST:
+        raise PyComfoConnectNotExist()
+    elif message.cmd.result == GatewayOperation.RMI_ERROR:
+        raise PyComfoConnectRmiError()
+
+
+def decode_rpdo_value(pdid, data, definitions=SENSOR_DEFINITIONS):
+    """Convert the payload of a CnRpdoNotification to a typed and scaled value."""
+
+    definition = definitions.get(pdid)
+    if definition is None or len(data) < definition.struct.size:
+        return decode_rpdo_data(data)
+
+    return definition.decode(data)
+
+
+def decode_rpdo_data(data):
+    """Convert the payload of a CnRpdoNotification of an unknown sensor to a value."""
+
+    if len(data) == 1:
+        return struct.unpack('b', data)[0]
+    elif len(data) == 2:
+        return struct.unpack('h', data)[0]
+    else:
+        return data.hex()
+
+
 class ComfoConnect(object):
     """Implements the commands to communicate with the ComfoConnect ventilation unit."""
 
@@ -117,20 +184,69 @@ class ComfoConnect(object):
     callback_sensor = None
 
     def __init__(self, bridge: Bridge, local_uuid=DEFAULT_LOCAL_UUID, local_devicename=DEFAULT_LOCAL_DEVICENAME,
-                 pin=DEFAULT_PIN):
+                 pin=DEFAULT_PIN, max_in_flight=MAX_IN_FLIGHT, dispatcher: Dispatcher = None,
+                 history: SensorHistory = None, recorder: NotificationLog = None, metrics: MetricsSink = None,
+                 reconnect: ReconnectStrategy = None, keepalive: float = KEEPALIVE,
+                 dead_peer_timeout: float = DEAD_PEER_TIMEOUT):
         self._bridge = bridge
+        self._dispatcher = dispatcher
         self._local_uuid = local_uuid
         self._local_devicename = local_devicename
         self._pin = pin
         self._reference = 1
+        self._reference_lock = threading.Lock()
 
-        self._queue = queue.Queue()
+        self._pending = {}
+        self._window = threading.BoundedSemaphore(max_in_flight)
         self._connected = threading.Event()
         self._stopping = False
+        self._wakeup = threading.Event()
         self._message_thread = None
         self._connection_thread = None
 
         self.sensors = {}
+        self._sensor_definitions = dict(SENSOR_DEFINITIONS)
+
+        # Latest value of every sensor, and optionally the recent history
+        self.state = SensorStateCache()
+        self.history = history
+        if history is not None and not history.definitions:
+            history.definitions = self._sensor_definitions
+
+        # Optional log on disk of every sensor notification
+        self.recorder = recorder
+
+        # Optional instrumentation
+        self.metrics = metrics
+        if metrics is not None:
+            if bridge.metrics is None:
+                bridge.metrics = metrics
+            metrics.register_gauge('comfoconnect_pending_requests', lambda: len(self._pending))
+            metrics.register_gauge('comfoconnect_registered_sensors', lambda: len(self.sensors))
+            if dispatcher is not None:
+                metrics.register_gauge('comfoconnect_dispatch_queue_depth', lambda: dispatcher.depth)
+
+        # How we restore the connection when it's lost, and how long the last outage took
+        self.reconnect = reconnect or ReconnectStrategy()
+        self.last_outage = None
+
+        # How long the connection can be idle before we send a keepalive, or before we consider it dead
+        self.keepalive = keepalive
+        self.dead_peer_timeout = dead_peer_timeout
+        self._next_probe = 0
+
+        # Policies that filter the sensor updates before they are passed on to the callback, and the ones that hold
+        # back an update as a heap of (due, sequence, sensor_id, policy)
+        self._policies = {}
+        self._held = []
+        self._held_sequence = itertools.count()
+
+        # Handlers that subscribed to sensor updates, and the sensors we registered on their behalf
+        self._subscriptions = SubscriptionRegistry()
+        self._subscribed_sensors = set()
+
+        # Serializes the changes to the subscriptions together with the (un)registrations on the bridge
+        self._subscription_lock = threading.Lock()
 
     # ==================================================================================================================
     # Core functions
@@ -155,6 +271,7 @@ class ComfoConnect(object):
 
         # Set the stopping flag
         self._stopping = False
+        self._wakeup.clear()
         self._connected.clear()
 
         # Start connection thread
@@ -169,20 +286,31 @@ class ComfoConnect(object):
     def disconnect(self):
         """Disconnect from the bridge."""
 
-        # Set the stopping flag
+        # Set the stopping flag, and stop waiting for the next reconnect attempt
         self._stopping = True
+        self._wakeup.set()
 
         # Wait for the background thread to finish
         self._connection_thread.join()
         self._connection_thread = None
 
+        # Pass on the updates that are still queued and stop the worker threads
+        if self._dispatcher is not None:
+            self._dispatcher.close()
+
+        # Make sure the recorded notifications are on disk
+        if self.recorder is not None:
+            self.recorder.commit()
+
     def is_connected(self):
         """Returns whether there is a connection with the bridge."""
 
         return self._bridge.is_connected()
 
-    def register_sensor(self, sensor_id: int, sensor_type: int = None):
-        """Register a sensor on the bridge and keep it in memory that we are registered to this sensor."""
+    def register_sensor(self, sensor_id: int, sensor_type: int = None, policy: DispatchPolicy = None):
+        """Register a sensor on the bridge and keep it in memory that we are registered to this sensor.
+
+        The optional policy decides which updates of this sensor are passed on to the callback."""
 
         if not sensor_type:
             sensor_type = RPDO_TYPE_MAP.get(sensor_id)
@@ -190,6 +318,10 @@ class ComfoConnect(object):
         if sensor_type is None:
             raise Exception("Registering sensor %d with unknown type" % sensor_id)
 
+        # Prepare the decoder and the policy first, since the updates can arrive before the confirm
+        self._register_definition(sensor_id, sensor_type)
+        self.set_policy(sensor_id, policy)
+
         # Register on bridge
         try:
             reply = self.cmd_rpdo_request(sensor_id, sensor_type)
@@ -202,6 +334,139 @@ class ComfoConnect(object):
 
         return reply
 
+    def register_sensors(self, sensors, timeout=5):
+        """Register multiple sensors on the bridge at once and return a dict with the success for each sensor.
+
+        The sensors can be given as sensor ids or as (sensor_id, sensor_type) tuples. The timeout applies to the whole
+        batch, not to every sensor."""
+
+        # Resolve the types first, so we don't register half of the list
+        sensor_types = {}
+        for sensor in sensors:
+            if isinstance(sensor, tuple):
+                sensor_id, sensor_type = sensor
+            else:
+                sensor_id, sensor_type = sensor, None
+
+            if not sensor_type:
+                sensor_type = RPDO_TYPE_MAP.get(sensor_id)
+
+            if sensor_type is None:
+                raise Exception("Registering sensor %d with unknown type" % sensor_id)
+
+            sensor_types[sensor_id] = sensor_type
+
+        # Prepare the decoders first, since the updates can arrive before the confirm
+        for sensor_id, sensor_type in sensor_types.items():
+            self._register_definition(sensor_id, sensor_type)
+
+        # Sending the requests and collecting the confirms all share one deadline
+        deadline = time.monotonic() + timeout
+        futures = {}
+
+        try:
+            # Send all requests to the bridge
+            for sensor_id, sensor_type in sensor_types.items():
+                params = {'pdid': sensor_id, 'type': sensor_type, 'zone': 1}
+                try:
+                    futures[sensor_id] = self._submit(CnRpdoRequest, params, deadline)
+                except ValueError:
+                    # The window stayed full until the deadline, so the other sensors won't fit either
+                    break
+
+            # Collect the confirms
+            results = {}
+            for sensor_id, sensor_type in sensor_types.items():
+                future = futures.get(sensor_id)
+                if future is None:
+                    _LOGGER.warning('Could not register sensor %d: the request was never sent', sensor_id)
+                    results[sensor_id] = False
+                    continue
+
+                try:
+                    self._get_reply(future, timeout=max(deadline - time.monotonic(), 0))
+
+                except (ValueError, BrokenPipeError, PyComfoConnectError) as exc:
+                    _LOGGER.warning('Could not register sensor %d: %s', sensor_id, exc.__class__.__name__)
+                    results[sensor_id] = False
+                    continue
+
+                # Register in memory
+                self.sensors[sensor_id] = sensor_type
+                results[sensor_id] = True
+
+            return results
+
+        finally:
+            # Don't keep a slot in the window when sending failed halfway
+            for future in futures.values():
+                if self._pending.pop(future.reference, None) is not None:
+                    future.cancel()
+
+    def subscribe(self, sensor_ids, handler) -> Subscription:
+        """Invoke handler(sensor_id, value) for the updates of one or more sensors.
+
+        The first subscriber of a sensor registers it on the bridge, and the last one to unsubscribe unregisters it
+        again."""
+
+        if isinstance(sensor_ids, int):
+            sensor_ids = [sensor_ids]
+
+        subscription = Subscription(self, sensor_ids, handler)
+
+        with self._subscription_lock:
+            self._subscriptions.add(subscription)
+
+            # Register the sensors that aren't registered yet, including the ones that failed for an earlier subscriber
+            missing = [sensor_id for sensor_id in subscription.sensor_ids if sensor_id not in self.sensors]
+            if missing:
+                try:
+                    results = self.register_sensors(missing)
+                except Exception:
+                    self._remove_subscription(subscription)
+                    raise
+
+                self._subscribed_sensors.update(sensor_id for sensor_id, success in results.items() if success)
+
+                failed = sorted(sensor_id for sensor_id, success in results.items() if not success)
+                if failed:
+                    self._remove_subscription(subscription)
+                    raise Exception('Could not register sensors %s' % ', '.join(str(sensor_id) for sensor_id in failed))
+
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        """Stop invoking the handler of a subscription."""
+
+        with self._subscription_lock:
+            if subscription.active:
+                self._remove_subscription(subscription)
+
+    def _remove_subscription(self, subscription: Subscription):
+        """Remove a subscription and unregister the sensors that nobody is listening to anymore."""
+
+        subscription.active = False
+
+        for sensor_id in self._subscriptions.remove(subscription):
+            if sensor_id in self._subscribed_sensors:
+                self._subscribed_sensors.discard(sensor_id)
+                if sensor_id in self.sensors:
+                    self.unregister_sensor(sensor_id)
+
+    def set_policy(self, sensor_id: int, policy: DispatchPolicy = None):
+        """Set the policy that decides which updates of a sensor are passed on to the callback."""
+
+        if policy is None:
+            self._policies.pop(sensor_id, None)
+        else:
+            self._policies[sensor_id] = policy
+
+    def _register_definition(self, sensor_id: int, sensor_type: int):
+        """Make sure we can decode a sensor that was registered with a type that we don't know."""
+
+        if sensor_id not in self._sensor_definitions and sensor_type in TYPE_FORMATS:
+            self._sensor_definitions[sensor_id] = SensorDefinition(sensor_id, sensor_type)
+
     def unregister_sensor(self, sensor_id: int, sensor_type: int = None):
         """Register a sensor on the bridge and keep it in memory that we are registered to this sensor."""
 
@@ -213,96 +478,161 @@ class ComfoConnect(object):
 
         # Unregister in memory
         self.sensors.pop(sensor_id, None)
+        self._policies.pop(sensor_id, None)
 
         # Unregister on bridge
         self.cmd_rpdo_request(sensor_id, sensor_type, timeout=0)
 
-    def _command(self, command, params=None, use_queue=True):
+    def batch(self, requests, timeout=5):
+        """Sends a list of (command, params) requests pipelined and returns their replies in the same order.
+
+        The timeout applies to the whole batch, including the time we wait for room in the window."""
+
+        deadline = time.monotonic() + timeout
+        futures = []
+
+        try:
+            for command, params in requests:
+                futures.append(self._submit(command, params, deadline))
+
+            return [
+                self._get_reply(future, timeout=max(deadline - time.monotonic(), 0)) if future else None
+                for future in futures
+            ]
+
+        finally:
+            # Don't keep a slot in the window for the requests we are not waiting for anymore
+            for future in futures:
+                if future and self._pending.pop(future.reference, None) is not None:
+                    future.cancel()
+
+    def _command(self, command, params=None, use_queue=True, timeout=5):
         """Sends a command and wait for a response if the request is known to return a result."""
 
+        deadline = time.monotonic() + timeout
+        future = self._submit(command, params, deadline)
+        if future is None:
+            return None
+
+        return self._get_reply(future, timeout=max(deadline - time.monotonic(), 0), use_queue=use_queue)
+
+    def _submit(self, command, params=None, deadline=None):
+        """Sends a command without waiting and returns a Future for the reply, or None if no reply is expected.
+
+        When the window of outstanding requests is full, we wait for room until the monotonic deadline."""
+
+        # Reserve a message reference
+        with self._reference_lock:
+            reference = self._reference
+            self._reference += 1
+
         # Construct the message
         message = Message.create(
             self._local_uuid,
             self._bridge.uuid,
             command,
-            {'reference': self._reference},
+            {'reference': reference},
             params
         )
 
-        # Increase message reference
-        self._reference += 1
+        # Check if this command has a confirm type set
+        if command not in message.class_to_confirm:
+            self._bridge.write_message(message)
+            return None
+
+        # Wait until there is room in the window of outstanding requests
+        timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+        if not self._window.acquire(timeout=timeout):
+            raise ValueError('Timeout waiting for room in the window of outstanding requests.')
 
-        # Send the message
-        self._bridge.write_message(message)
+        # Register the pending request before sending, so the reply can never arrive before we are waiting for it
+        future = Future()
+        future.reference = reference
+        future.command = command.__name__
+        future.add_done_callback(lambda _: self._window.release())
+        self._pending[reference] = future
+
+        if self.metrics is not None:
+            future.add_done_callback(self._measure_reply(command.__name__))
 
         try:
-            # Check if this command has a confirm type set
-            confirm_type = message.class_to_confirm[command]
+            # Send the message
+            self._bridge.write_message(message)
 
-            # Read a message
-            reply = self._get_reply(confirm_type, use_queue=use_queue)
+        except Exception:
+            self._pending.pop(reference, None)
+            future.cancel()
+            raise
 
-            return reply
+        return future
 
-        except KeyError:
-            return None
+    def _get_reply(self, future, timeout=5, use_queue=True):
+        """Waits until the reply for a pending request has arrived."""
 
-    def _get_reply(self, confirm_type=None, timeout=5, use_queue=True):
-        """Pops a message of the queue, optionally looking for a specific type."""
+        deadline = time.monotonic() + timeout
 
-        start = time.time()
+        if not use_queue:
+            # There is no message thread yet, so we fetch the messages directly from the socket
+            while not future.done():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
 
-        while True:
-            message = None
+                message = self._bridge.read_message(timeout=remaining)
+                if message:
+                    self._handle_reply(message)
 
-            if use_queue:
-                try:
-                    # Fetch the message from the queue.  The network thread has put it there for us.
-                    message = self._queue.get(timeout=timeout)
-                    if message:
-                        self._queue.task_done()
-                except queue.Empty:
-                    # We got no message
-                    pass
+        try:
+            # Don't wait longer than what is left of the timeout
+            return future.result(timeout=max(deadline - time.monotonic(), 0))
 
-            else:
-                # Fetch the message directly from the socket
-                message = self._bridge.read_message(timeout=timeout)
+        except FutureTimeoutError:
+            # Give up on this request
+            if self._pending.pop(future.reference, None) is not None:
+                future.cancel()
+            if self.metrics is not None:
+                self.metrics.increment('comfoconnect_reply_timeouts_total', labels={'command': future.command})
+            raise ValueError('Timeout waiting for response.')
 
-            if message:
-                # Check status code
-                if message.cmd.result == GatewayOperation.OK:
-                    pass
-                elif message.cmd.result == GatewayOperation.BAD_REQUEST:
-                    raise PyComfoConnectBadRequest()
-                elif message.cmd.result == GatewayOperation.INTERNAL_ERROR:
-                    raise PyComfoConnectInternalError()
-                elif message.cmd.result == GatewayOperation.NOT_REACHABLE:
-                    raise PyComfoConnectNotReachable()
-                elif message.cmd.result == GatewayOperation.OTHER_SESSION:
-                    raise PyComfoConnectOtherSession(message.msg.devicename)
-                elif message.cmd.result == GatewayOperation.NOT_ALLOWED:
-                    raise PyComfoConnectNotAllowed()
-                elif message.cmd.result == GatewayOperation.NO_RESOURCES:
-                    raise PyComfoConnectNoResources()
-                elif message.cmd.result == GatewayOperation.NOT_EXIST:
-                    raise PyComfoConnectNotExist()
-                elif message.cmd.result == GatewayOperation.RMI_ERROR:
-                    raise PyComfoConnectRmiError()
-
-                if confirm_type is None:
-                    # We just need a message
-                    return message
-                elif message.msg.__class__ == confirm_type:
-                    # We need the message with the correct type
-                    return message
-                else:
-                    # We got a message with an incorrect type. Hopefully, this doesn't happen to often,
-                    # since we just put it back on the queue.
-                    self._queue.put(message)
+    def _fail_pending(self, exc):
+        """Fail the requests that are still waiting for a reply, since the reply will never arrive."""
+
+        while self._pending:
+            try:
+                _, future = self._pending.popitem()
+            except KeyError:
+                break
+
+            future.set_exception(exc)
+
+    def _measure_reply(self, command_name):
+        """Returns a callback that records the round-trip time of a request when its reply arrives."""
+
+        sent = time.monotonic()
+        labels = {'command': command_name}
+
+        def measure(future):
+            if not future.cancelled():
+                self.metrics.observe('comfoconnect_command_duration_seconds', time.monotonic() - sent, labels)
+
+        return measure
+
+    def _handle_reply(self, message):
+        """Completes the pending request that matches the reference of this reply."""
 
-            if time.time() - start > timeout:
-                raise ValueError('Timeout waiting for response.')
+        future = self._pending.pop(message.cmd.reference, None)
+        if future is None:
+            # Nobody is waiting for this reply anymore, like the replies to probes and to requests that timed out
+            _LOGGER.debug('Dropping reply without pending request: %s', message)
+            return
+
+        try:
+            # Check status code
+            check_result(message)
+        except PyComfoConnectError as exc:
+            future.set_exception(exc)
+        else:
+            future.set_result(message)
 
     # ==================================================================================================================
     # Connection thread
@@ -311,43 +641,79 @@ class ComfoConnect(object):
         """Makes sure that there is a connection open."""
 
         self._stopping = False
+        lost = None
         while not self._stopping:
 
             # Start connection
-            if not self.is_connected():
-
-                # Wait a bit to avoid hammering the bridge
-                time.sleep(5)
-
-                try:
-                    # Connect or re-connect
-                    self._connect()
-
-                except PyComfoConnectOtherSession:
-                    self._bridge.disconnect()
-                    _LOGGER.error('Could not connect to the bridge since there is already an open session.')
-                    continue
-
-                except Exception as exc:
-                    _LOGGER.error(exc)
-                    raise Exception('Could not connect to the bridge.')
+            if not self.is_connected() and not self._reconnect():
+                return
 
             # Start background thread
             self._message_thread = threading.Thread(target=self._message_thread_loop)
             self._message_thread.start()
 
-            # Re-register for sensor updates
-            for sensor_id in self.sensors:
-                self.cmd_rpdo_request(sensor_id, self.sensors[sensor_id])
+            # Re-register for sensor updates. The callback, the subscriptions and the policies are kept as they are.
+            try:
+                self.register_sensors(list(self.sensors.items()))
+            except Exception as exc:
+                # The message thread notices when the connection is gone, and we try again after the reconnect
+                _LOGGER.warning('Could not register the sensors again: %s', exc)
 
             # Send the event that we are ready
             self._connected.set()
 
+            if lost is not None:
+                self.last_outage = time.monotonic() - lost
+                _LOGGER.info('The connection was restored after %.1f seconds.', self.last_outage)
+                if self.metrics is not None:
+                    self.metrics.observe('comfoconnect_outage_duration_seconds', self.last_outage)
+
             # Wait until the message thread stops working
             self._message_thread.join()
+            lost = time.monotonic()
+
+            # Close socket connection, unless sending already did that when it failed
+            if self.is_connected():
+                self._bridge.disconnect()
+
+    def _reconnect(self) -> bool:
+        """Try to restore the connection until it succeeds, and return False when we are stopping or give up."""
+
+        attempt = 0
+        while not self._stopping:
+            if self.reconnect.exhausted(attempt):
+                _LOGGER.error('Could not reconnect to the bridge after %d attempts. Giving up.', attempt)
+                return False
+
+            # Wait a bit to avoid hammering the bridge, but stop waiting when we are disconnecting
+            if self._wakeup.wait(self.reconnect.delay(attempt)):
+                return False
+            attempt += 1
+
+            if self.metrics is not None:
+                self.metrics.increment('comfoconnect_reconnects_total')
+
+            try:
+                # Connect or re-connect
+                self._connect()
+                return True
+
+            except PyComfoConnectOtherSession:
+                _LOGGER.error('Could not connect to the bridge since there is already an open session.')
+
+            except PyComfoConnectNotAllowed:
+                _LOGGER.error('Could not connect to the bridge since the PIN seems to be invalid. Giving up.')
+                if self.is_connected():
+                    self._bridge.disconnect()
+                return False
+
+            except Exception as exc:
+                _LOGGER.warning('Could not reconnect to the bridge: %s', exc)
 
-            # Close socket connection
-            self._bridge.disconnect()
+            if self.is_connected():
+                self._bridge.disconnect()
+
+        return False
 
     def _connect(self, takeover=False):
         """Connect to the bridge and login. Disconnect existing clients if needed by default."""
@@ -375,27 +741,38 @@ class ComfoConnect(object):
     # ==================================================================================================================
 
     def _message_thread_loop(self):
-        """Listen for incoming messages and queue them or send them to a callback method."""
+        """Listen for incoming messages until the connection is lost."""
+
+        try:
+            self._receive_messages()
 
-        # Reinitialise the queues
-        self._queue = queue.Queue()
+        finally:
+            # Nobody is reading the replies anymore, so don't let the callers wait for their timeout
+            self._fail_pending(BrokenPipeError('The connection was lost.'))
 
-        next_keepalive = 0
+    def _receive_messages(self):
+        """Listen for incoming messages and pass them on to the pending requests or to the callback method."""
+
+        self._next_probe = 0
 
         while not self._stopping:
 
-            # Sends a keepalive every KEEPALIVE seconds.
-            if time.time() > next_keepalive:
-                next_keepalive = time.time() + KEEPALIVE
-                self.cmd_keepalive()
+            # Sends a keepalive when the connection was idle, and check if the bridge is still there
+            wait = self._check_idle()
+            if wait is None:
+                # Close this thread. The connection_thread will restart us.
+                return
+
+            # Pass on the sensor updates that were held back by a policy
+            timeout = self._flush_policies(min(wait, 1))
 
             try:
                 # Read a message from the bridge.
-                message = self._bridge.read_message()
+                message = self._bridge.read_message(timeout=timeout)
 
             except BrokenPipeError as exc:
                 # Close this thread. The connection_thread will restart us.
-                _LOGGER.warning('The connection was broken. We will try to reconnect later.')
+                _LOGGER.warning('The connection was broken: %s. We will try to reconnect later.', exc)
                 return
 
             if message:
@@ -426,8 +803,8 @@ class ComfoConnect(object):
                     return
 
                 else:
-                    # Send other messages to a queue
-                    self._queue.put(message)
+                    # Hand the reply to the command that is waiting for it
+                    self._handle_reply(message)
 
         return
 
@@ -439,23 +816,132 @@ class ComfoConnect(object):
             return False
 
         # Extract data
-        data = message.msg.data.hex()
-        if len(data) == 2:
-            val = struct.unpack('b', message.msg.data)[0]
-        elif len(data) == 4:
-            val = struct.unpack('h', message.msg.data)[0]
-        elif len(data) == 8:
-            val = data
-        else:
-            val = data
+        val = decode_rpdo_value(message.msg.pdid, message.msg.data, self._sensor_definitions)
 
         # Update local state
-        # self.sensors[message.msg.pdid] = val
+        now = time.time()
+        self.state.update(message.msg.pdid, val, now)
+        if self.history is not None:
+            self.history.record(message.msg.pdid, val, now)
+        if self.recorder is not None:
+            self.recorder.append(now, message.msg.pdid, message.msg.data)
+
+        # Check if the policy wants us to pass this update on
+        policy = self._policies.get(message.msg.pdid)
+        if policy is not None:
+            holding = policy.next_due() is not None
+            if not policy.offer(val, time.monotonic()):
+                # Remember when to pass on an update that it started to hold back
+                due = policy.next_due()
+                if due is not None and not holding:
+                    heapq.heappush(self._held, (due, next(self._held_sequence), message.msg.pdid, policy))
+                return True
+
+        self._dispatch(message.msg.pdid, val)
+
+        return True
+
+    def _dispatch(self, sensor_id, val):
+        """Pass a sensor update on to the callback and the subscribers, through the dispatcher if we have one."""
+
+        if not self.callback_sensor and not self._subscriptions.get(sensor_id):
+            return
+
+        if self._dispatcher is not None:
+            self._dispatcher.submit(self._notify, sensor_id, val)
+        else:
+            self._notify(sensor_id, val)
+
+    def _notify(self, sensor_id, val):
+        """Invoke the callback and the handlers that subscribed to this sensor."""
+
+        if self.metrics is not None:
+            start = time.perf_counter()
+            self._invoke_handlers(sensor_id, val)
+            self.metrics.observe('comfoconnect_callback_duration_seconds', time.perf_counter() - start)
+        else:
+            self._invoke_handlers(sensor_id, val)
+
+    def _invoke_handlers(self, sensor_id, val):
+        """Invoke the callback and the handlers of the subscriptions."""
 
         if self.callback_sensor:
-            self.callback_sensor(message.msg.pdid, val)
+            self.callback_sensor(sensor_id, val)
 
-        return True
+        for subscription in self._subscriptions.get(sensor_id):
+            try:
+                subscription.handler(sensor_id, val)
+            except Exception:
+                _LOGGER.exception('Handler for sensor %d failed', sensor_id)
+
+    def _check_idle(self):
+        """Send a keepalive or a probe when the connection has been idle.
+
+        Returns the seconds until we need to check again, or None when the bridge doesn't respond anymore."""
+
+        now = time.monotonic()
+
+        # Only send a keepalive when we didn't send anything else for a while
+        tx_idle = now - (self._bridge.last_tx or 0)
+        if tx_idle >= self.keepalive and self.is_connected():
+            self.cmd_keepalive()
+            tx_idle = 0
+        wait = self.keepalive - tx_idle
+
+        if not self.is_connected():
+            # Sending failed and closed the connection, here or in another thread
+            _LOGGER.warning('The connection was broken. We will try to reconnect later.')
+            return None
+
+        if self.dead_peer_timeout:
+            rx_idle = now - (self._bridge.last_rx or now)
+            if rx_idle >= self.dead_peer_timeout:
+                _LOGGER.warning('The bridge did not respond for %.0f seconds. We will try to reconnect later.', rx_idle)
+                return None
+
+            # Ask the bridge for a reply when it has been quiet for a while
+            interval = self.dead_peer_timeout / 3
+            if rx_idle >= interval and now >= self._next_probe:
+                self._next_probe = now + interval
+                self._probe()
+
+            wait = min(wait, self.dead_peer_timeout - rx_idle, interval if rx_idle >= interval else interval - rx_idle)
+
+        return wait
+
+    def _probe(self):
+        """Send a request that the bridge has to answer, without waiting for the answer."""
+
+        with self._reference_lock:
+            reference = self._reference
+            self._reference += 1
+
+        self._bridge.write_message(
+            Message.create(self._local_uuid, self._bridge.uuid, CnTimeRequest, {'reference': reference})
+        )
+
+    def _flush_policies(self, timeout=1):
+        """Invoke the callback for the held back sensor updates that are due and return how long we can wait.
+
+        Only the policies that hold back an update are looked at, in the order they are due."""
+
+        now = time.monotonic()
+        held = self._held
+        while held and held[0][0] <= now:
+            _, _, sensor_id, policy = heapq.heappop(held)
+
+            # Skip the policies that were replaced or removed in the meantime
+            if self._policies.get(sensor_id) is not policy:
+                continue
+
+            due, val = policy.poll(now)
+            if due:
+                self._dispatch(sensor_id, val)
+
+        if held:
+            timeout = min(timeout, max(held[0][0] - now, 0))
+
+        return timeout
 
     # ==================================================================================================================
     # Commands
@@ -561,6 +1047,15 @@ class ComfoConnect(object):
         )
         return True
 
+    def cmd_rmi_request_batch(self, messages, node_id: int = 1, timeout=5):
+        """Sends a list of RMI requests pipelined and returns the responses in the same order."""
+
+        replies = self.batch(
+            [(CnRmiRequest, {'nodeId': node_id or 1, 'message': message}) for message in messages],
+            timeout=timeout
+        )
+        return [reply.msg.message for reply in replies]
+
     def cmd_rpdo_request(self, pdid: int, type: int = 1, zone: int = 1, timeout=None, use_queue: bool = True):
         """Register a RPDO request."""
 
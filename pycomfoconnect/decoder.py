@@ -0,0 +1,285 @@
+"""
+Decode a capture into columnar files with the values of every sensor and a table of the RMI requests.
+
+The input can be a capture written by CaptureWriter, or a raw stream of frames like the hex dumps of
+example/manually_decode.py after they have been passed through `xxd -r -p`. A raw stream has no timestamps, so the
+frame number is used instead.
+
+Usage:
+  $ python3 -m pycomfoconnect.decoder capture.bin --output decoded/ --format csv --jobs 4
+"""
+import argparse
+import csv
+import mmap
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
+
+from .capture import CAPTURE_MAGIC, FRAME_HEADER
+from .comfoconnect import RPDO_TYPE_MAP, SENSOR_DEFINITIONS
+from .message import *
+from .recorder import TYPE_DTYPES, decode_values, record_dtype
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Minimum number of frames we give to a worker
+CHUNK_FRAMES = 50000
+
+DIRECTION_UNKNOWN = 255
+
+
+def index_frames(buffer, capture: bool) -> list:
+    """Returns the offset of every frame in the buffer, and the end of the last complete frame."""
+
+    offsets = []
+    size = len(buffer)
+    position = len(CAPTURE_MAGIC) if capture else 0
+
+    while True:
+        if capture:
+            if position + FRAME_HEADER.size > size:
+                break
+            length = struct.unpack_from('<L', buffer, position + 9)[0]
+            end = position + FRAME_HEADER.size + length
+        else:
+            if position + 4 > size:
+                break
+            end = position + 4 + struct.unpack_from('>L', buffer, position)[0]
+
+        if end > size:
+            # The last frame was only partly written
+            break
+
+        offsets.append(position)
+        position = end
+
+    offsets.append(position)
+    return offsets
+
+
+def _iter_frames(buffer, capture: bool, start: int, end: int, first_frame: int):
+    """Yields the frame number, timestamp, direction and packet of the frames in a part of the buffer."""
+
+    frame = first_frame
+    position = start
+    while position < end:
+        if capture:
+            timestamp, direction, length = FRAME_HEADER.unpack_from(buffer, position)
+            position += FRAME_HEADER.size
+        else:
+            length = 4 + struct.unpack_from('>L', buffer, position)[0]
+            timestamp, direction = float(frame), DIRECTION_UNKNOWN
+
+        yield frame, timestamp, direction, buffer[position:position + length]
+        position += length
+        frame += 1
+
+
+def decode_chunk(path: str, capture: bool, start: int, end: int, first_frame: int):
+    """Decode a part of a capture and return the sensor notifications, the sensor types and the RMI messages."""
+
+    types = {}
+    rmis = []
+    timestamps = []
+    pdids = []
+    lengths = []
+    data = []
+
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        for frame, timestamp, direction, packet in _iter_frames(buffer, capture, start, end, first_frame):
+            message = Message.decode(packet)
+            cmd_type = message.cmd.type
+
+            if cmd_type == GatewayOperation.CnRpdoNotificationType:
+                value = message.msg.data
+                if len(value) <= 8:
+                    timestamps.append(timestamp)
+                    pdids.append(message.msg.pdid)
+                    lengths.append(len(value))
+                    data.append(value.ljust(8, b'\x00'))
+
+            elif cmd_type == GatewayOperation.CnRpdoRequestType:
+                types[message.msg.pdid] = message.msg.type
+
+            elif cmd_type == GatewayOperation.CnRmiRequestType:
+                rmis.append((frame, timestamp, message.cmd.reference, 'tx', message.msg.nodeId, None,
+                             message.msg.message.hex()))
+
+            elif cmd_type == GatewayOperation.CnRmiResponseType:
+                rmis.append((frame, timestamp, message.cmd.reference, 'rx', None, message.cmd.result,
+                             message.msg.message.hex()))
+
+    records = np.zeros(len(pdids), dtype=record_dtype())
+    if len(pdids):
+        records['timestamp'] = timestamps
+        records['pdid'] = pdids
+        records['length'] = lengths
+        records['data'] = np.frombuffer(b''.join(data), dtype=np.uint8).reshape(-1, 8)
+
+    return records, types, rmis
+
+
+def join_rmis(rmis: list) -> list:
+    """Match every RMI request with the first response with the same reference that follows it."""
+
+    rows = []
+    pending = {}
+    for frame, timestamp, reference, direction, node_id, result, payload in sorted(rmis):
+        if direction == 'tx':
+            row = {
+                'frame': frame,
+                'timestamp': timestamp,
+                'reference': reference,
+                'node_id': node_id,
+                'request': payload,
+                'result': None,
+                'response': None,
+                'latency': None,
+            }
+            pending[reference] = row
+            rows.append(row)
+        else:
+            row = pending.pop(reference, None)
+            if row is None:
+                # We didn't capture the request
+                rows.append({
+                    'frame': frame,
+                    'timestamp': timestamp,
+                    'reference': reference,
+                    'node_id': None,
+                    'request': None,
+                    'result': result,
+                    'response': payload,
+                    'latency': None,
+                })
+                continue
+            row['result'] = result
+            row['response'] = payload
+            row['latency'] = timestamp - row['timestamp']
+
+    return rows
+
+
+def decode_capture(path: str, jobs: int = None):
+    """Decode a capture and return a dict with the timestamps and values of every sensor, and the RMI table."""
+
+    if np is None:
+        raise ImportError('The capture decoder requires numpy. Install it with `pip install pycomfoconnect[recorder]`.')
+
+    with open(path, 'rb') as file:
+        capture = file.read(len(CAPTURE_MAGIC)) == CAPTURE_MAGIC
+        if os.fstat(file.fileno()).st_size == 0:
+            return {}, []
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            offsets = index_frames(buffer, capture)
+
+    # Split the capture in chunks at frame boundaries
+    frames = len(offsets) - 1
+    jobs = jobs or os.cpu_count() or 1
+    chunk_frames = max(CHUNK_FRAMES, -(-frames // (jobs * 4)))
+    chunks = [
+        (path, capture, offsets[first], offsets[min(first + chunk_frames, frames)], first)
+        for first in range(0, frames, chunk_frames)
+    ]
+
+    if jobs == 1 or len(chunks) <= 1:
+        results = [decode_chunk(*chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(decode_chunk, *zip(*chunks)))
+
+    # Merge the results of the chunks
+    types = dict(RPDO_TYPE_MAP)
+    rmis = []
+    for _, chunk_types, chunk_rmis in results:
+        types.update(chunk_types)
+        rmis.extend(chunk_rmis)
+
+    records = np.concatenate([chunk_records for chunk_records, _, _ in results]) if results else \
+        np.zeros(0, dtype=record_dtype())
+
+    return split_sensors(records, types), join_rmis(rmis)
+
+
+def split_sensors(records, types: dict) -> dict:
+    """Group the notifications per sensor and decode their values."""
+
+    sensors = {}
+    if not len(records):
+        return sensors
+
+    # A stable sort keeps the notifications of every sensor in the order they were received
+    order = np.argsort(records['pdid'], kind='stable')
+    records = records[order]
+    pdids, starts = np.unique(records['pdid'], return_index=True)
+    ends = np.append(starts[1:], len(records))
+
+    for pdid, start, end in zip(pdids.tolist(), starts.tolist(), ends.tolist()):
+        sensor_records = records[start:end]
+        sensor_type = types.get(pdid)
+        definition = SENSOR_DEFINITIONS.get(pdid)
+
+        if sensor_type in TYPE_DTYPES:
+            values = decode_values(sensor_records, sensor_type, definition.divisor if definition else 1)
+        else:
+            # We don't know how to decode this sensor, so we keep the raw bytes as hex
+            values = np.array([
+                bytes(row['data'][:row['length']]).hex() for row in sensor_records
+            ])
+
+        sensors[pdid] = (sensor_records['timestamp'].copy(), values)
+
+    return sensors
+
+
+def write_output(directory: str, sensors: dict, rmis: list, output_format: str = 'npz'):
+    """Write the sensors as npz or CSV files, and the RMI table as a CSV file."""
+
+    os.makedirs(directory, exist_ok=True)
+
+    if output_format == 'npz':
+        arrays = {}
+        for pdid, (timestamps, values) in sensors.items():
+            arrays['pdid_%d_timestamp' % pdid] = timestamps
+            arrays['pdid_%d_value' % pdid] = values
+        np.savez(os.path.join(directory, 'sensors.npz'), **arrays)
+
+    elif output_format == 'csv':
+        for pdid, (timestamps, values) in sensors.items():
+            with open(os.path.join(directory, 'pdid_%d.csv' % pdid), 'w', newline='') as file:
+                writer = csv.writer(file)
+                writer.writerow(['timestamp', 'value'])
+                writer.writerows(zip(timestamps.tolist(), values.tolist()))
+
+    else:
+        raise ValueError('Unknown output format %s' % output_format)
+
+    with open(os.path.join(directory, 'rmi.csv'), 'w', newline='') as file:
+        writer = csv.DictWriter(
+            file, ['frame', 'timestamp', 'reference', 'node_id', 'request', 'result', 'response', 'latency']
+        )
+        writer.writeheader()
+        writer.writerows(rmis)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Decode a ComfoConnect capture.')
+    parser.add_argument('capture', help='capture file, or a raw stream of frames')
+    parser.add_argument('--output', '-o', default='decoded', help='directory for the decoded files')
+    parser.add_argument('--format', '-f', default='npz', choices=['npz', 'csv'], help='format of the sensor files')
+    parser.add_argument('--jobs', '-j', type=int, default=None, help='number of processes (default: all cores)')
+    args = parser.parse_args(argv)
+
+    sensors, rmis = decode_capture(args.capture, args.jobs)
+    write_output(args.output, sensors, rmis, args.format)
+
+    for pdid, (timestamps, _) in sorted(sensors.items()):
+        print('pdid %d: %d values' % (pdid, len(timestamps)))
+    print('RMI requests: %d' % len(rmis))
+
+
+if __name__ == '__main__':
+    main()
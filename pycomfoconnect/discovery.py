@@ -0,0 +1,437 @@
+import asyncio
+import ipaddress
+import json
+import logging
+import os
+import select
+import socket
+import threading
+import time
+
+from .aiobridge import AsyncBridge
+from .bridge import Bridge
+from .zehnder_pb2 import DiscoveryOperation
+
+_LOGGER = logging.getLogger('discovery')
+
+# The search request that a bridge answers with its address and uuid
+SEARCH_REQUEST = b"\x0a\x00"
+
+# Target that sends a broadcast on the network of the default interface
+BROADCAST = '<broadcast>'
+
+# Number of probes we send before we check for responses again
+SEND_BATCH = 256
+
+# Seconds we wait for the connection to a cached address before we fall back to a live discovery
+CACHED_CONNECT_TIMEOUT = 1
+
+# Seconds we wait for a cached bridge to confirm its uuid
+REVALIDATE_TIMEOUT = 2
+
+
+def expand_targets(targets=None):
+    """Expand a list of hosts, broadcast addresses and CIDR ranges to the addresses we need to probe.
+
+    When no targets are given, we only send a broadcast. The addresses are generated lazily, so large ranges never
+    end up in memory."""
+
+    if targets is None:
+        targets = [BROADCAST]
+    elif isinstance(targets, str):
+        targets = [targets]
+
+    # Single hosts we have seen, and the ranges we have expanded already
+    seen = set()
+    networks = []
+    for target in targets:
+        network = None
+        if '/' in target:
+            network = ipaddress.ip_network(target, strict=False)
+            addresses = (str(address) for address in network.hosts()) if network.num_addresses > 1 \
+                else [str(network.network_address)]
+        else:
+            addresses = [target]
+
+        for address in addresses:
+            if address in seen or _in_networks(address, networks):
+                continue
+            if network is None:
+                seen.add(address)
+            yield address
+
+        if network is not None:
+            networks.append(network)
+
+
+def _in_networks(address: str, networks) -> bool:
+    """Returns whether an address was probed as one of the hosts of the networks."""
+
+    if not networks:
+        return False
+
+    try:
+        address = ipaddress.ip_address(address)
+    except ValueError:
+        # Host names and the broadcast target
+        return False
+
+    for network in networks:
+        # The network and broadcast addresses of a range are not hosts, so they were never probed
+        if address in network and (network.num_addresses <= 2 or
+                                   address not in (network.network_address, network.broadcast_address)):
+            return True
+
+    return False
+
+
+def _is_unicast(targets) -> bool:
+    """Returns weather all targets are single hosts, so we can stop when they have all answered.
+
+    Addresses ending in .255 are considered to be the broadcast address of an interface."""
+
+    if targets is None:
+        return False
+
+    if isinstance(targets, str):
+        targets = [targets]
+
+    for target in targets:
+        if target == BROADCAST or target.endswith('.255'):
+            return False
+        if '/' in target and ipaddress.ip_network(target, strict=False).num_addresses > 1:
+            return False
+
+    return True
+
+
+def _parse_response(data):
+    """Returns the address and uuid from a discovery response, or None when it's not a valid response."""
+
+    parser = DiscoveryOperation()
+    try:
+        parser.ParseFromString(data)
+    except Exception:
+        return None
+
+    if not parser.HasField('searchGatewayResponse'):
+        return None
+
+    return parser.searchGatewayResponse.ipaddress, parser.searchGatewayResponse.uuid
+
+
+def iter_discover(targets=None, timeout=5, port=Bridge.PORT):
+    """Probe all targets concurrently from one socket and yield a Bridge for every bridge that responds.
+
+    Targets can be hosts, broadcast addresses of the interfaces to search, or CIDR ranges. Every bridge is reported
+    once, and the search stops after timeout seconds in total, or as soon as all unicast targets have answered."""
+
+    deadline = time.monotonic() + timeout
+    addresses = expand_targets(targets)
+    address = next(addresses, None)
+
+    # Unicast targets are single hosts, so counting them is cheap
+    expected = len(set(expand_targets(targets))) if _is_unicast(targets) else None
+
+    udpsocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udpsocket.setblocking(0)
+    udpsocket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+
+    found = set()
+    try:
+        while True:
+            wait = deadline - time.monotonic()
+            if wait <= 0:
+                break
+
+            # Send the next batch of probes, but keep reading the responses in between
+            for _ in range(SEND_BATCH):
+                if address is None:
+                    break
+                try:
+                    udpsocket.sendto(SEARCH_REQUEST, (address, port))
+                except BlockingIOError:
+                    break
+                except OSError as exc:
+                    _LOGGER.debug('Could not send a discovery probe to %s: %s', address, exc)
+                address = next(addresses, None)
+
+            ready = select.select([udpsocket], [udpsocket] if address is not None else [], [], wait)
+            if not ready[0]:
+                continue
+
+            while True:
+                try:
+                    data, source = udpsocket.recvfrom(100)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except OSError as exc:
+                    # ICMP errors of unicast probes to hosts that are down end up here
+                    _LOGGER.debug('Error while receiving a discovery response: %s', exc)
+                    continue
+
+                response = _parse_response(data)
+                if response is None or response[1] in found:
+                    continue
+
+                found.add(response[1])
+                yield Bridge(response[0], response[1], port)
+
+            # Don't wait for the timeout when all hosts we asked directly have answered
+            if expected is not None and len(found) >= expected:
+                break
+
+    finally:
+        udpsocket.close()
+
+
+def discover(targets=None, timeout=5, port=Bridge.PORT) -> list:
+    """Probe all targets concurrently and return the bridges that responded."""
+
+    return list(iter_discover(targets, timeout, port))
+
+
+class _StreamingDiscoveryProtocol(asyncio.DatagramProtocol):
+    """Passes the responses to a discovery probe on to a queue."""
+
+    def __init__(self):
+        self.responses = asyncio.Queue()
+
+    def datagram_received(self, data, addr):
+        response = _parse_response(data)
+        if response is not None:
+            self.responses.put_nowait(response)
+
+    def error_received(self, exc):
+        _LOGGER.debug('Error while receiving a discovery response: %s', exc)
+
+
+async def aiter_discover(targets=None, timeout=5, port=AsyncBridge.PORT):
+    """Probe all targets concurrently and yield an AsyncBridge for every bridge that responds.
+
+    This is the asyncio version of iter_discover."""
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    expected = len(set(expand_targets(targets))) if _is_unicast(targets) else None
+
+    transport, protocol = await loop.create_datagram_endpoint(
+        _StreamingDiscoveryProtocol,
+        family=socket.AF_INET,
+        allow_broadcast=True
+    )
+
+    async def send_probes():
+        for count, address in enumerate(expand_targets(targets), 1):
+            try:
+                transport.sendto(SEARCH_REQUEST, (address, port))
+            except OSError as exc:
+                _LOGGER.debug('Could not send a discovery probe to %s: %s', address, exc)
+
+            # Let the responses come in while we scan large ranges
+            if count % SEND_BATCH == 0:
+                await asyncio.sleep(0)
+
+    sender = asyncio.ensure_future(send_probes())
+
+    found = set()
+    try:
+        while True:
+            wait = deadline - loop.time()
+            if wait <= 0:
+                break
+
+            try:
+                ip_address, uuid = await asyncio.wait_for(protocol.responses.get(), wait)
+            except asyncio.TimeoutError:
+                break
+
+            if uuid in found:
+                continue
+
+            found.add(uuid)
+            yield AsyncBridge(ip_address, uuid, port)
+
+            # Don't wait for the timeout when all hosts we asked directly have answered
+            if expected is not None and len(found) >= expected:
+                break
+
+    finally:
+        sender.cancel()
+        transport.close()
+
+
+async def async_discover(targets=None, timeout=5, port=AsyncBridge.PORT) -> list:
+    """Probe all targets concurrently and return the bridges that responded."""
+
+    return [bridge async for bridge in aiter_discover(targets, timeout, port)]
+
+
+def default_cache_path() -> str:
+    """Returns the default location of the discovery cache."""
+
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'pycomfoconnect', 'bridges.json')
+
+
+class DiscoveryCache(object):
+    """Remembers the address of every bridge we have seen, so we can connect without waiting for a discovery.
+
+    A cached address is confirmed with a unicast discovery, that is answered right away by the bridge. We only fall
+    back to a live discovery when the bridge can't be reached on its cached address anymore, or when another bridge
+    answers on it."""
+
+    def __init__(self, path: str = None, targets=None, timeout=5):
+        self.path = path or default_cache_path()
+        self.targets = targets
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._entries = self._load()
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path) as file:
+                entries = json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+        if not isinstance(entries, dict):
+            return {}
+
+        return entries
+
+    def _save(self):
+        """Write the cache atomically, so another process never reads half of it."""
+
+        with self._lock:
+            data = json.dumps(self._entries, indent=2, sort_keys=True)
+
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            temp_path = '%s.%d.tmp' % (self.path, os.getpid())
+            with open(temp_path, 'w') as file:
+                file.write(data)
+            os.replace(temp_path, self.path)
+        except OSError as exc:
+            _LOGGER.warning('Could not write the discovery cache %s: %s', self.path, exc)
+
+    def get(self, uuid: bytes) -> dict:
+        """Returns the cached host, port and last_seen time of a bridge, or None when it's not cached."""
+
+        with self._lock:
+            entry = self._entries.get(uuid.hex())
+
+        return dict(entry) if entry else None
+
+    def update(self, bridge):
+        """Store the address of a bridge that we have just seen."""
+
+        with self._lock:
+            self._entries[bridge.uuid.hex()] = {
+                'host': bridge.host,
+                'port': bridge.port,
+                'last_seen': time.time(),
+            }
+
+        self._save()
+
+    def remove(self, uuid: bytes):
+        """Forget the address of a bridge."""
+
+        with self._lock:
+            removed = self._entries.pop(uuid.hex(), None)
+
+        if removed is not None:
+            self._save()
+
+    def _discover(self, uuid: bytes, targets, port):
+        """Run a live discovery and return the bridge with this uuid, or None when it didn't respond."""
+
+        found = None
+        for bridge in iter_discover(targets, self.timeout, port):
+            self.update(bridge)
+            if bridge.uuid == uuid:
+                found = bridge
+                # When we probe the whole network, others might still answer, but we don't need to wait for them
+                break
+
+        return found
+
+    def _revalidate(self, bridge) -> bool:
+        """Confirm that the bridge still has its cached address.
+
+        Returns False when another bridge answered on the address. A bridge that doesn't answer at all is given the
+        benefit of the doubt, since we could connect to it."""
+
+        for response in iter_discover([bridge.host], REVALIDATE_TIMEOUT, bridge.port):
+            if response.uuid == bridge.uuid:
+                self.update(response)
+                return True
+
+            _LOGGER.warning('Another bridge answered on the cached address %s of %s', bridge.host, bridge.uuid.hex())
+            self.remove(bridge.uuid)
+            return False
+
+        _LOGGER.debug('Bridge %s did not answer the discovery on %s', bridge.uuid.hex(), bridge.host)
+        return True
+
+    def connect(self, uuid: bytes, port: int = Bridge.PORT) -> Bridge:
+        """Returns a connected Bridge with this uuid.
+
+        The cached address is tried first and revalidated before we return. A live discovery is only done when there
+        is no cached address, when the connection to it fails, or when another bridge has taken over the address."""
+
+        entry = self.get(uuid)
+        if entry is not None:
+            bridge = Bridge(entry['host'], uuid, entry.get('port', port))
+            try:
+                bridge.connect(CACHED_CONNECT_TIMEOUT)
+            except OSError as exc:
+                _LOGGER.info('Could not connect to the cached address %s of %s: %s', entry['host'], uuid.hex(), exc)
+                self.remove(uuid)
+            else:
+                if self._revalidate(bridge):
+                    return bridge
+                bridge.disconnect()
+
+        bridge = self._discover(uuid, self.targets, port)
+        if bridge is None:
+            raise Exception('Could not find bridge %s.' % uuid.hex())
+
+        bridge.connect()
+        return bridge
+
+    async def async_connect(self, uuid: bytes, port: int = AsyncBridge.PORT) -> AsyncBridge:
+        """Returns a connected AsyncBridge with this uuid.
+
+        This is the asyncio version of connect. The cache is read and written from a thread, so it doesn't block
+        the event loop."""
+
+        loop = asyncio.get_running_loop()
+
+        entry = self.get(uuid)
+        if entry is not None:
+            bridge = AsyncBridge(entry['host'], uuid, entry.get('port', port))
+            try:
+                await asyncio.wait_for(bridge.connect(), CACHED_CONNECT_TIMEOUT)
+            except (OSError, asyncio.TimeoutError) as exc:
+                _LOGGER.info('Could not connect to the cached address %s of %s: %s', entry['host'], uuid.hex(), exc)
+                await loop.run_in_executor(None, self.remove, uuid)
+            else:
+                if await loop.run_in_executor(None, self._revalidate, bridge):
+                    return bridge
+                await bridge.disconnect()
+
+        found = None
+        async for response in aiter_discover(self.targets, self.timeout, port):
+            await loop.run_in_executor(None, self.update, response)
+            if response.uuid == uuid:
+                found = response
+                break
+
+        if found is None:
+            raise Exception('Could not find bridge %s.' % uuid.hex())
+
+        await found.connect()
+        return found
@@ -0,0 +1,171 @@
+import collections
+import logging
+import threading
+
+_LOGGER = logging.getLogger('dispatch')
+
+# What to do when the queue is full
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_COALESCE = 'coalesce'
+
+
+class Dispatcher(object):
+    """Invokes the sensor callbacks on a pool of worker threads, so a slow callback never stalls the message thread.
+
+    The updates of a sensor always go to the same worker, so they are passed on one at a time and in order.
+
+    When the queue is full, the overflow policy decides what happens:
+    - OVERFLOW_BLOCK: wait until there is room in the queue again.
+    - OVERFLOW_DROP_OLDEST: drop the oldest update in the queue.
+    - OVERFLOW_COALESCE: replace the value of an update of the same sensor that is still queued, or drop the oldest
+      update if there is none.
+    """
+
+    def __init__(self, workers: int = 1, maxsize: int = 1000, overflow: str = OVERFLOW_BLOCK):
+        if overflow not in (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_COALESCE):
+            raise ValueError('Unknown overflow policy %s' % overflow)
+
+        if maxsize < 1:
+            raise ValueError('The queue should have room for at least one update.')
+
+        self.workers = workers
+        self.maxsize = maxsize
+        self.overflow = overflow
+
+        # One queue for every worker, and the number of updates in all of them
+        self._queues = [collections.deque() for _ in range(max(workers, 1))]
+        self._size = 0
+        self._sequence = 0
+        self._queued = {}
+        self._condition = threading.Condition()
+        self._threads = []
+        self._closing = False
+
+        # Counters
+        self.submitted = 0
+        self.processed = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.errors = 0
+
+    @property
+    def depth(self) -> int:
+        """Number of updates that are waiting in the queue."""
+
+        return self._size
+
+    def stats(self) -> dict:
+        """Returns the counters of the dispatcher."""
+
+        return {
+            'depth': self.depth,
+            'submitted': self.submitted,
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+            'errors': self.errors,
+        }
+
+    def submit(self, callback, sensor_id: int, value):
+        """Queue a sensor update for the callback."""
+
+        with self._condition:
+            if self._closing:
+                return
+
+            if not self._threads:
+                self._start()
+
+            self.submitted += 1
+
+            if self._size >= self.maxsize:
+                if self.overflow == OVERFLOW_BLOCK:
+                    while self._size >= self.maxsize and not self._closing:
+                        self._condition.wait()
+
+                    if self._closing:
+                        # The workers might be gone already, so nobody would pick this update up
+                        self.dropped += 1
+                        return
+
+                elif self.overflow == OVERFLOW_COALESCE and sensor_id in self._queued:
+                    # Replace the value of the update that is already waiting
+                    self._queued[sensor_id][2] = value
+                    self.coalesced += 1
+                    return
+
+                else:
+                    self._drop_oldest()
+                    self.dropped += 1
+
+            self._sequence += 1
+            item = [sensor_id, callback, value, self._sequence]
+            self._queues[sensor_id % len(self._queues)].append(item)
+            self._size += 1
+            self._queued[sensor_id] = item
+            self._condition.notify_all()
+
+    def close(self, timeout: float = None):
+        """Process the updates that are still queued and stop the workers.
+
+        The workers are started again by the next update that is submitted."""
+
+        with self._condition:
+            self._closing = True
+            self._condition.notify_all()
+
+        for thread in self._threads:
+            thread.join(timeout)
+
+        with self._condition:
+            self._threads = []
+            self._closing = False
+
+    def _start(self):
+        for index in range(len(self._queues)):
+            thread = threading.Thread(target=self._worker_loop, args=(index,), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _drop_oldest(self):
+        """Drop the update that was queued first."""
+
+        oldest = min((queue for queue in self._queues if queue), key=lambda queue: queue[0][3])
+        self._forget(oldest.popleft())
+        self._size -= 1
+
+    def _forget(self, item):
+        if self._queued.get(item[0]) is item:
+            del self._queued[item[0]]
+
+    def _worker_loop(self, index: int):
+        """Take updates from the queue of this worker and invoke their callback."""
+
+        queue = self._queues[index]
+        while True:
+            with self._condition:
+                while not queue and not self._closing:
+                    self._condition.wait()
+
+                if not queue:
+                    # We are closing and everything has been processed
+                    return
+
+                item = queue.popleft()
+                self._size -= 1
+                self._forget(item)
+                self._condition.notify_all()
+
+            sensor_id, callback, value, _ = item
+            failed = False
+            try:
+                callback(sensor_id, value)
+            except Exception:
+                failed = True
+                _LOGGER.exception('Callback for sensor %d failed', sensor_id)
+
+            with self._condition:
+                self.processed += 1
+                if failed:
+                    self.errors += 1
@@ -0,0 +1,336 @@
+import asyncio
+import logging
+import math
+import time
+
+from .aiobridge import AsyncBridge
+from .aiocomfoconnect import AsyncComfoConnect, NOTIFICATION_QUEUE_SIZE, put_latest
+from .comfoconnect import KEEPALIVE, DEAD_PEER_TIMEOUT, DEFAULT_LOCAL_UUID, DEFAULT_LOCAL_DEVICENAME, DEFAULT_PIN, \
+    RPDO_TYPE_MAP, decode_rpdo_value
+from .reconnect import ReconnectStrategy
+
+_LOGGER = logging.getLogger('fleet')
+
+
+class Timer(object):
+    """Handle of a callback that was scheduled on a TimerWheel."""
+
+    __slots__ = ('callback', 'args', 'rounds', 'cancelled')
+
+    def __init__(self, callback, args, rounds):
+        self.callback = callback
+        self.args = args
+        self.rounds = rounds
+        self.cancelled = False
+
+    def cancel(self):
+        """Don't invoke the callback."""
+
+        self.cancelled = True
+
+
+class TimerWheel(object):
+    """Runs the timers of all the bridges of a pool from a single task.
+
+    Timers are hashed into slots of resolution seconds, so scheduling and cancelling are O(1) and every tick only
+    looks at the timers of one slot. Timers fire up to one resolution late."""
+
+    def __init__(self, resolution: float = 0.1, slots: int = 512):
+        self.resolution = resolution
+        self._slots = [[] for _ in range(slots)]
+        self._position = 0
+        self._task = None
+
+    def schedule(self, delay: float, callback, *args) -> Timer:
+        """Invoke callback(*args) after delay seconds."""
+
+        ticks = max(1, math.ceil(delay / self.resolution))
+        timer = Timer(callback, args, (ticks - 1) // len(self._slots))
+        self._slots[(self._position + ticks) % len(self._slots)].append(timer)
+
+        return timer
+
+    def start(self):
+        """Start ticking on the running event loop."""
+
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Stop ticking."""
+
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time() + self.resolution
+
+        while True:
+            await asyncio.sleep(max(next_tick - loop.time(), 0))
+
+            # Catch up with the ticks we missed when the loop was busy
+            while loop.time() >= next_tick:
+                self._advance()
+                next_tick += self.resolution
+
+    def _advance(self):
+        self._position = (self._position + 1) % len(self._slots)
+
+        timers = self._slots[self._position]
+        if not timers:
+            return
+
+        # Timers that are scheduled by the callbacks end up in the new list
+        self._slots[self._position] = []
+        for timer in timers:
+            if timer.cancelled:
+                continue
+
+            if timer.rounds:
+                timer.rounds -= 1
+                self._slots[self._position].append(timer)
+                continue
+
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                _LOGGER.exception('Timer callback failed')
+
+
+class PooledComfoConnect(AsyncComfoConnect):
+    """A connection to one bridge of a BridgePool.
+
+    It uses the timer wheel of the pool for its keepalives and reply timeouts, and passes its sensor updates on to the
+    notification stream of the pool."""
+
+    def __init__(self, pool, bridge: AsyncBridge, local_uuid=DEFAULT_LOCAL_UUID,
+                 local_devicename=DEFAULT_LOCAL_DEVICENAME, pin=DEFAULT_PIN, keepalive: float = KEEPALIVE,
+                 dead_peer_timeout: float = DEAD_PEER_TIMEOUT):
+        super().__init__(bridge, local_uuid, local_devicename, pin, keepalive, dead_peer_timeout)
+        self.uuid = bridge.uuid
+        self._pool = pool
+        self._keepalive_timer = None
+        self._closing = False
+        self._established = False
+        self.reconnect_attempts = 0
+
+        # When we lost the connection, and how long the last outage took
+        self.lost_at = None
+        self.last_outage = None
+
+    async def connect(self, takeover=False):
+        self._closing = False
+        result = await super().connect(takeover)
+        self._established = True
+        return result
+
+    async def disconnect(self):
+        self._closing = True
+        await super().disconnect()
+
+    async def _wait_reply(self, future, timeout):
+        timer = self._pool.wheel.schedule(timeout, self._expire, future)
+        try:
+            return await future
+        finally:
+            timer.cancel()
+
+    @staticmethod
+    def _expire(future):
+        if not future.done():
+            future.set_exception(ValueError('Timeout waiting for response.'))
+
+    def _start_keepalive(self):
+        self._next_probe = 0
+        self._keepalive_timer = self._pool.wheel.schedule(0, self._keepalive)
+
+    def _keepalive(self):
+        if not self.is_connected():
+            return
+
+        wait = self._check_idle()
+        if wait is not None:
+            self._keepalive_timer = self._pool.wheel.schedule(wait, self._keepalive)
+
+    async def _close(self):
+        if self._keepalive_timer is not None:
+            self._keepalive_timer.cancel()
+            self._keepalive_timer = None
+
+        await super()._close()
+
+    async def _read_loop(self):
+        try:
+            await super()._read_loop()
+        finally:
+            if self._keepalive_timer is not None:
+                self._keepalive_timer.cancel()
+                self._keepalive_timer = None
+
+            # A failed connect is retried by the pool itself
+            if self._established and not self._closing:
+                self._pool._connection_lost(self)
+            self._established = False
+
+    def _handle_rpdo_notification(self, message):
+        """Update internal sensor state and pass the update on to the pool."""
+
+        val = decode_rpdo_value(message.msg.pdid, message.msg.data)
+        self.state.update(message.msg.pdid, val, time.time())
+        for queue in self._pool._consumers:
+            put_latest(queue, (self.uuid, message.msg.pdid, val))
+
+
+class BridgePool(object):
+    """Keeps sessions with many bridges on a single event loop.
+
+    All bridges share one timer wheel for their keepalives, reply timeouts and reconnects, and their sensor updates
+    are passed on to one stream of (uuid, sensor_id, value) tuples."""
+
+    def __init__(self, local_uuid=DEFAULT_LOCAL_UUID, local_devicename=DEFAULT_LOCAL_DEVICENAME, pin=DEFAULT_PIN,
+                 resolution: float = 0.1, reconnect: ReconnectStrategy = None, keepalive: float = KEEPALIVE,
+                 dead_peer_timeout: float = DEAD_PEER_TIMEOUT):
+        self._local_uuid = local_uuid
+        self._local_devicename = local_devicename
+        self._pin = pin
+        self.reconnect = reconnect or ReconnectStrategy()
+        self.keepalive = keepalive
+        self.dead_peer_timeout = dead_peer_timeout
+
+        self.wheel = TimerWheel(resolution)
+        self._members = {}
+
+        # The queue of every notifications iterator
+        self._consumers = set()
+        self._running = False
+
+    def __getitem__(self, uuid) -> PooledComfoConnect:
+        return self._members[uuid]
+
+    def __contains__(self, uuid):
+        return uuid in self._members
+
+    def __len__(self):
+        return len(self._members)
+
+    @property
+    def members(self) -> list:
+        """Returns the connections to the bridges in the pool."""
+
+        return list(self._members.values())
+
+    def add(self, bridge: AsyncBridge, sensors=()) -> PooledComfoConnect:
+        """Add a bridge to the pool and register these sensors when it's connected.
+
+        The sensors can be given as sensor ids or as (sensor_id, sensor_type) tuples."""
+
+        if bridge.uuid in self._members:
+            raise Exception('Bridge %s is already in the pool' % bridge.uuid.hex())
+
+        member = PooledComfoConnect(self, bridge, self._local_uuid, self._local_devicename, self._pin,
+                                    self.keepalive, self.dead_peer_timeout)
+        for sensor in sensors:
+            sensor_id, sensor_type = sensor if isinstance(sensor, tuple) else (sensor, RPDO_TYPE_MAP.get(sensor))
+            if sensor_type is None:
+                raise Exception("Registering sensor %d with unknown type" % sensor_id)
+            member.sensors[sensor_id] = sensor_type
+
+        self._members[bridge.uuid] = member
+
+        if self._running:
+            asyncio.ensure_future(self._connect(member))
+
+        return member
+
+    async def remove(self, uuid):
+        """Disconnect a bridge and remove it from the pool."""
+
+        member = self._members.pop(uuid)
+        await member.disconnect()
+
+    async def start(self) -> dict:
+        """Connect to all bridges and return a dict with the success for each bridge.
+
+        Bridges that can't be reached are retried in the background."""
+
+        self._running = True
+        self.wheel.start()
+
+        members = list(self._members.values())
+        results = await asyncio.gather(*(self._connect(member) for member in members))
+
+        return {member.uuid: result for member, result in zip(members, results)}
+
+    async def stop(self):
+        """Disconnect from all bridges."""
+
+        self._running = False
+        await asyncio.gather(*(member.disconnect() for member in self._members.values()), return_exceptions=True)
+        await self.wheel.stop()
+
+        # End the notification streams
+        for queue in self._consumers:
+            put_latest(queue, None)
+
+    async def notifications(self):
+        """Iterate over the sensor updates of all bridges as (uuid, sensor_id, value) tuples until the pool stops.
+
+        Every iterator gets all updates, that are only queued while it is iterating."""
+
+        queue = asyncio.Queue(NOTIFICATION_QUEUE_SIZE)
+        self._consumers.add(queue)
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                yield item
+        finally:
+            self._consumers.discard(queue)
+
+    async def _connect(self, member: PooledComfoConnect) -> bool:
+        """Connect to a bridge, and schedule a new attempt when that fails."""
+
+        if not self._running or member.is_connected():
+            return member.is_connected()
+
+        try:
+            await member.connect()
+
+        except Exception as exc:
+            _LOGGER.warning('Could not connect to bridge %s: %s', member.uuid.hex(), exc)
+            self._schedule_reconnect(member)
+            return False
+
+        member.reconnect_attempts = 0
+        if member.lost_at is not None:
+            member.last_outage = time.monotonic() - member.lost_at
+            member.lost_at = None
+            _LOGGER.info('Restored the connection to bridge %s after %.1f seconds', member.uuid.hex(),
+                         member.last_outage)
+
+        return True
+
+    def _connection_lost(self, member: PooledComfoConnect):
+        """Reconnect to a bridge that dropped the connection."""
+
+        if self._running and self._members.get(member.uuid) is member:
+            _LOGGER.warning('Lost the connection to bridge %s', member.uuid.hex())
+            member.lost_at = time.monotonic()
+            self._schedule_reconnect(member)
+
+    def _schedule_reconnect(self, member: PooledComfoConnect):
+        if self.reconnect.exhausted(member.reconnect_attempts):
+            _LOGGER.error('Could not reconnect to bridge %s after %d attempts. Giving up.', member.uuid.hex(),
+                          member.reconnect_attempts)
+            return
+
+        delay = self.reconnect.delay(member.reconnect_attempts)
+        member.reconnect_attempts += 1
+        self.wheel.schedule(delay, lambda: asyncio.ensure_future(self._connect(member)))
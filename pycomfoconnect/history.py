@@ -0,0 +1,161 @@
+import threading
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Default number of samples we keep per sensor
+DEFAULT_CAPACITY = 86400
+
+
+class RingBuffer(object):
+    """Keeps the last samples of a sensor in preallocated arrays.
+
+    The samples are appended by the message thread and read by other threads, so both take the lock. Queries return
+    copies, so they are never changed underneath the caller."""
+
+    def __init__(self, capacity: int, dtype):
+        if np is None:
+            raise ImportError('The sensor history requires numpy. '
+                              'Install it with `pip install pycomfoconnect[history]`.')
+
+        self.capacity = capacity
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        self.values = np.zeros(capacity, dtype=dtype)
+        self._next = 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def append(self, timestamp: float, value):
+        """Add a sample, overwriting the oldest one when the buffer is full."""
+
+        with self._lock:
+            # Store the value first, so a value that doesn't fit leaves the buffer untouched
+            self.values[self._next] = value
+            self.timestamps[self._next] = timestamp
+            self._next = (self._next + 1) % self.capacity
+            if self._count < self.capacity:
+                self._count += 1
+
+    def _segments(self):
+        """Returns the slices of the buffer in chronological order."""
+
+        if self._count < self.capacity:
+            return [slice(0, self._count)]
+
+        return [slice(self._next, self.capacity), slice(0, self._next)]
+
+    def query(self, start: float = None, end: float = None):
+        """Returns the timestamps and values of the samples with start <= timestamp < end."""
+
+        timestamps = []
+        values = []
+        with self._lock:
+            for segment in self._segments():
+                segment_timestamps = self.timestamps[segment]
+                low = 0 if start is None else np.searchsorted(segment_timestamps, start, side='left')
+                high = len(segment_timestamps) if end is None else np.searchsorted(segment_timestamps, end, side='left')
+                if high > low:
+                    timestamps.append(segment_timestamps[low:high])
+                    values.append(self.values[segment][low:high])
+
+            if not timestamps:
+                return np.empty(0, dtype=np.float64), np.empty(0, dtype=self.values.dtype)
+
+            # Copy the samples before we release the lock
+            return np.concatenate(timestamps), np.concatenate(values)
+
+    def downsample(self, interval: float, start: float = None, end: float = None):
+        """Returns the start, minimum, maximum and mean of every interval that has samples."""
+
+        timestamps, values = self.query(start, end)
+        if not len(timestamps):
+            empty = np.empty(0, dtype=np.float64)
+            return empty, np.empty(0, dtype=values.dtype), np.empty(0, dtype=values.dtype), empty
+
+        origin = np.floor(timestamps[0] / interval) * interval if start is None else start
+        bins = np.floor((timestamps - origin) / interval).astype(np.int64)
+
+        # The samples are sorted, so every bin is a contiguous run
+        offsets = np.flatnonzero(np.diff(bins, prepend=bins[0] - 1))
+        counts = np.diff(np.append(offsets, len(values)))
+
+        return (
+            origin + bins[offsets] * interval,
+            np.minimum.reduceat(values, offsets),
+            np.maximum.reduceat(values, offsets),
+            np.add.reduceat(values.astype(np.float64), offsets) / counts,
+        )
+
+    def __len__(self):
+        return self._count
+
+
+class SensorHistory(object):
+    """Keeps a ring buffer with the last samples of every sensor."""
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY, definitions: dict = None):
+        if np is None:
+            raise ImportError('The sensor history requires numpy. '
+                              'Install it with `pip install pycomfoconnect[history]`.')
+
+        self.capacity = capacity
+        self.definitions = definitions or {}
+        self._buffers = {}
+
+    def _dtype(self, pdid: int, value):
+        definition = self.definitions.get(pdid)
+        if definition is not None:
+            if definition.divisor != 1:
+                return np.float32
+            if definition.type in (3, 8):
+                # CN_UINT32 and CN_INT64 don't fit in an int32
+                return np.int64
+            return np.int32
+
+        if isinstance(value, float):
+            return np.float32
+
+        return np.int64
+
+    def record(self, pdid: int, value, timestamp: float):
+        """Add a sample of a sensor. Values that aren't numeric are ignored."""
+
+        buffer = self._buffers.get(pdid)
+        if buffer is None:
+            if not isinstance(value, (int, float)):
+                return
+            buffer = self._buffers[pdid] = RingBuffer(self.capacity, self._dtype(pdid, value))
+
+        try:
+            buffer.append(timestamp, value)
+        except (TypeError, ValueError, OverflowError):
+            pass
+
+    def buffer(self, pdid: int) -> RingBuffer:
+        """Returns the ring buffer of a sensor."""
+
+        return self._buffers.get(pdid)
+
+    def query(self, pdid: int, start: float = None, end: float = None):
+        """Returns the timestamps and values of a sensor with start <= timestamp < end."""
+
+        buffer = self._buffers.get(pdid)
+        if buffer is None:
+            return np.empty(0, dtype=np.float64), np.empty(0, dtype=np.float32)
+
+        return buffer.query(start, end)
+
+    def downsample(self, pdid: int, interval: float, start: float = None, end: float = None):
+        """Returns the start, minimum, maximum and mean of every interval of a sensor that has samples."""
+
+        buffer = self._buffers.get(pdid)
+        if buffer is None:
+            empty = np.empty(0, dtype=np.float64)
+            return empty, empty, empty, empty
+
+        return buffer.downsample(interval, start, end)
+
+    def __contains__(self, pdid):
+        return pdid in self._buffers
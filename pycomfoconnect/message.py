@@ -1,5 +1,6 @@
 import struct
 
+from . import codec
 from .error import *
 from .zehnder_pb2 import *
 
@@ -170,12 +171,28 @@ class Message(object):
         GatewayOperation.CnFupResetConfirmType: CnFupResetConfirm,
     }
 
-    def __init__(self, cmd, msg, src, dst):
+    def __init__(self, cmd, msg, src, dst, msg_buf=None):
         self.cmd = cmd
-        self.msg = msg
         self.src = src
         self.dst = dst
 
+        # The body is only parsed when it's accessed for the first time
+        self._msg = msg
+        self._msg_buf = msg_buf
+
+    @property
+    def msg(self):
+        if self._msg is None:
+            # Try the fast codec first
+            msg = codec.decode_body(self.cmd.type, self._msg_buf) if codec.ENABLED else None
+            if msg is None:
+                msg = self.request_type_to_class_mapping.get(self.cmd.type)()
+                msg.ParseFromString(self._msg_buf)
+            self._msg = msg
+            self._msg_buf = None
+
+        return self._msg
+
     @classmethod
     def create(cls, src, dst, command, cmd_params=None, msg_params=None):
 
@@ -214,20 +231,20 @@ class Message(object):
 
     @classmethod
     def decode(cls, packet):
+        """Decode a packet. Only the command is parsed right away, the message is parsed when it's accessed."""
 
-        src_buf = packet[4:20]
-        dst_buf = packet[20:36]
-        cmd_len = struct.unpack('>H', packet[36:38])[0]
+        packet = memoryview(packet)
+
+        src_buf = bytes(packet[4:20])
+        dst_buf = bytes(packet[20:36])
+        cmd_len = struct.unpack_from('>H', packet, 36)[0]
         cmd_buf = packet[38:38 + cmd_len]
         msg_buf = packet[38 + cmd_len:]
 
-        # Parse command
-        cmd = GatewayOperation()
-        cmd.ParseFromString(cmd_buf)
-
-        # Parse message
-        cmd_type = cls.request_type_to_class_mapping.get(cmd.type)
-        msg = cmd_type()
-        msg.ParseFromString(msg_buf)
+        # Parse command, and fall back to protobuf if the fast codec can't handle it
+        cmd = codec.decode_gateway_operation(cmd_buf) if codec.ENABLED else None
+        if cmd is None:
+            cmd = GatewayOperation()
+            cmd.ParseFromString(cmd_buf)
 
-        return Message(cmd, msg, src_buf, dst_buf)
+        return Message(cmd, None, src_buf, dst_buf, msg_buf)
@@ -0,0 +1,196 @@
+import bisect
+import functools
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .zehnder_pb2 import GatewayOperation
+
+# Upper bounds of the histogram buckets in seconds
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+@functools.lru_cache(maxsize=None)
+def operation_name(cmd_type: int) -> str:
+    """Returns the name of a GatewayOperation type, to use as a label."""
+
+    try:
+        return GatewayOperation.OperationType.Name(cmd_type)
+    except ValueError:
+        return str(cmd_type)
+
+
+class MetricsSink(object):
+    """Receives the measurements of a Bridge and a ComfoConnect. This sink ignores them.
+
+    Instrumentation is disabled by not setting a sink at all, so a disabled sink costs a single `is None` check."""
+
+    def increment(self, name: str, value: float = 1, labels: dict = None):
+        """Add a value to a counter."""
+
+    def observe(self, name: str, value: float, labels: dict = None):
+        """Add a measurement to a histogram."""
+
+    def set_gauge(self, name: str, value: float, labels: dict = None):
+        """Set the value of a gauge."""
+
+    def register_gauge(self, name: str, function, labels: dict = None):
+        """Set a gauge that is evaluated by calling function when the metrics are collected."""
+
+
+class InMemoryMetrics(MetricsSink):
+    """Keeps the metrics in memory and exposes them in the Prometheus text format."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._gauge_functions = {}
+        self._histograms = {}
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted(labels.items())) if labels else ()
+
+    def increment(self, name: str, value: float = 1, labels: dict = None):
+        key = self._key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, labels: dict = None):
+        key = self._key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram[0][bisect.bisect_left(self.buckets, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def set_gauge(self, name: str, value: float, labels: dict = None):
+        key = self._key(labels)
+        with self._lock:
+            self._gauges.setdefault(name, {})[key] = value
+
+    def register_gauge(self, name: str, function, labels: dict = None):
+        key = self._key(labels)
+        with self._lock:
+            self._gauge_functions.setdefault(name, {})[key] = function
+
+    def counter(self, name: str, labels: dict = None) -> float:
+        """Returns the value of a counter."""
+
+        return self._counters.get(name, {}).get(self._key(labels), 0)
+
+    def histogram(self, name: str, labels: dict = None) -> dict:
+        """Returns the bucket counts, sum and count of a histogram."""
+
+        histogram = self._histograms.get(name, {}).get(self._key(labels))
+        if histogram is None:
+            return None
+
+        return {
+            'buckets': dict(zip(self.buckets + (float('inf'),), histogram[0])),
+            'sum': histogram[1],
+            'count': histogram[2],
+        }
+
+    def _collect_gauges(self) -> dict:
+        with self._lock:
+            gauges = {name: dict(series) for name, series in self._gauges.items()}
+            functions = {name: dict(series) for name, series in self._gauge_functions.items()}
+
+        for name, series in functions.items():
+            for key, function in series.items():
+                try:
+                    gauges.setdefault(name, {})[key] = function()
+                except Exception:
+                    pass
+
+        return gauges
+
+    def exposition(self) -> str:
+        """Returns the metrics in the Prometheus text exposition format."""
+
+        gauges = self._collect_gauges()
+
+        with self._lock:
+            counters = {name: dict(series) for name, series in self._counters.items()}
+            histograms = {
+                name: {key: (list(value[0]), value[1], value[2]) for key, value in series.items()}
+                for name, series in self._histograms.items()
+            }
+
+        lines = []
+        for name, series in sorted(counters.items()):
+            lines.append('# TYPE %s counter' % name)
+            for key, value in sorted(series.items()):
+                lines.append('%s%s %s' % (name, _format_labels(key), _format_value(value)))
+
+        for name, series in sorted(gauges.items()):
+            lines.append('# TYPE %s gauge' % name)
+            for key, value in sorted(series.items()):
+                lines.append('%s%s %s' % (name, _format_labels(key), _format_value(value)))
+
+        for name, series in sorted(histograms.items()):
+            lines.append('# TYPE %s histogram' % name)
+            for key, (counts, total, count) in sorted(series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    le = '+Inf' if bound == float('inf') else repr(float(bound))
+                    lines.append('%s_bucket%s %d' % (name, _format_labels(key + (('le', le),)), cumulative))
+                lines.append('%s_sum%s %s' % (name, _format_labels(key), _format_value(total)))
+                lines.append('%s_count%s %d' % (name, _format_labels(key), count))
+
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port: int = 9100, host: str = '0.0.0.0') -> ThreadingHTTPServer:
+        """Serve the metrics over HTTP on /metrics from a background thread. Call shutdown() on the result to stop."""
+
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+
+                body = metrics.exposition().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        return server
+
+
+def _format_labels(key) -> str:
+    if not key:
+        return ''
+
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in key
+    )
+
+
+def _format_value(value) -> str:
+    if isinstance(value, bool):
+        return '1' if value else '0'
+
+    if isinstance(value, int):
+        return str(value)
+
+    return repr(float(value))
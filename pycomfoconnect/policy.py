@@ -0,0 +1,111 @@
+class DispatchPolicy(object):
+    """Decides which sensor updates are passed on to the callback.
+
+    on_change: only pass values that differ from the last value that was passed on.
+    absolute: only pass values that differ at least this much from the last value that was passed on.
+    relative: only pass values that differ at least this fraction from the last value that was passed on.
+    min_interval: pass at most one value every min_interval seconds. A value that is held back is passed on when the
+                  interval has passed, unless a newer value has replaced it.
+    """
+
+    def __init__(self, on_change: bool = False, absolute: float = None, relative: float = None,
+                 min_interval: float = None):
+        self.on_change = on_change
+        self.absolute = absolute
+        self.relative = relative
+        self.min_interval = min_interval
+
+        self._last_value = None
+        self._last_time = None
+        self._pending = None
+        self._has_pending = False
+
+    def offer(self, value, now: float) -> bool:
+        """Returns whether this value should be passed on right now."""
+
+        if not self._is_significant(value):
+            # The latest value is close enough to what we passed on, so a held back value is outdated.
+            self._pending = None
+            self._has_pending = False
+            return False
+
+        if self.min_interval and self._last_time is not None and now - self._last_time < self.min_interval:
+            # Hold it back until the interval has passed
+            self._pending = value
+            self._has_pending = True
+            return False
+
+        self._dispatched(value, now)
+        return True
+
+    def poll(self, now: float):
+        """Returns (True, value) when a held back value should be passed on, or (False, None) otherwise."""
+
+        if not self._has_pending or now < self._last_time + self.min_interval:
+            return False, None
+
+        value = self._pending
+        self._dispatched(value, now)
+        return True, value
+
+    def next_due(self):
+        """Returns when the held back value should be passed on, or None if there is no such value."""
+
+        if not self._has_pending:
+            return None
+
+        return self._last_time + self.min_interval
+
+    def _is_significant(self, value) -> bool:
+        if self._last_time is None:
+            # The first value is always passed on
+            return True
+
+        if self.absolute is None and self.relative is None:
+            return not self.on_change or value != self._last_value
+
+        try:
+            delta = abs(value - self._last_value)
+        except TypeError:
+            # We can't measure the difference of non-numeric values, so we just compare them.
+            return value != self._last_value
+
+        if self.absolute is not None and delta >= self.absolute:
+            return True
+
+        if self.relative is not None and delta >= abs(self._last_value) * self.relative and delta > 0:
+            return True
+
+        return False
+
+    def _dispatched(self, value, now: float):
+        self._last_value = value
+        self._last_time = now
+        self._pending = None
+        self._has_pending = False
+
+    def __repr__(self):
+        return 'DispatchPolicy(on_change=%r, absolute=%r, relative=%r, min_interval=%r)' % (
+            self.on_change, self.absolute, self.relative, self.min_interval
+        )
+
+
+class OnChange(DispatchPolicy):
+    """Only pass values that differ from the last value that was passed on."""
+
+    def __init__(self, min_interval: float = None):
+        super().__init__(on_change=True, min_interval=min_interval)
+
+
+class Deadband(DispatchPolicy):
+    """Only pass values that moved out of the deadband around the last value that was passed on."""
+
+    def __init__(self, absolute: float = None, relative: float = None, min_interval: float = None):
+        super().__init__(absolute=absolute, relative=relative, min_interval=min_interval)
+
+
+class MinInterval(DispatchPolicy):
+    """Pass at most one value every interval seconds, and pass the latest held back value at the end."""
+
+    def __init__(self, interval: float):
+        super().__init__(min_interval=interval)
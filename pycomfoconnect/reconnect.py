@@ -0,0 +1,46 @@
+import random
+
+
+class ReconnectStrategy(object):
+    """Decides how long to wait before every attempt to restore a lost connection.
+
+    initial_delay: delay before the first attempt, so a short interruption is restored right away.
+    base_delay: delay before the second attempt, that is multiplied by multiplier for every next attempt.
+    max_delay: upper limit of the delay.
+    jitter: fraction of the delay that is randomized, so clients that lost their connection at the same moment don't
+            all reconnect at the same moment.
+    max_attempts: give up after this many attempts in a row, or never when None.
+    """
+
+    def __init__(self, initial_delay: float = 0, base_delay: float = 1, max_delay: float = 60,
+                 multiplier: float = 2, jitter: float = 0.5, max_attempts: int = None):
+        if not 0 <= jitter <= 1:
+            raise ValueError('The jitter should be between 0 and 1.')
+
+        self.initial_delay = initial_delay
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.max_attempts = max_attempts
+
+        self._random = random.Random()
+
+    def delay(self, attempt: int) -> float:
+        """Returns the seconds to wait before an attempt. The first attempt is attempt 0."""
+
+        if attempt == 0:
+            return self.initial_delay
+
+        try:
+            delay = min(self.base_delay * self.multiplier ** (attempt - 1), self.max_delay)
+        except OverflowError:
+            delay = self.max_delay
+
+        # Take a random part of the delay away, so we never wait longer than max_delay
+        return delay - delay * self.jitter * self._random.random()
+
+    def exhausted(self, attempt: int) -> bool:
+        """Returns whether we should give up instead of making this attempt."""
+
+        return self.max_attempts is not None and attempt >= self.max_attempts
@@ -0,0 +1,507 @@
+import collections
+import json
+import logging
+import os
+import struct
+import threading
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_LOGGER = logging.getLogger('recorder')
+
+# Every segment starts with a header of the same size as a record, so the records stay aligned
+SEGMENT_MAGIC = b'CCNLOG\x00\x00'
+SEGMENT_VERSION = 1
+SEGMENT_SUFFIX = '.seg'
+INDEX_SUFFIX = '.idx'
+INDEX_VERSION = 1
+HEADER = struct.Struct('<8sHH4xd')  # magic, version, record size, creation time
+
+# A record holds the timestamp, the pdid, the length of the raw value and the raw value padded to 8 bytes
+RECORD = struct.Struct('<dHB5x8s')
+RECORD_SIZE = RECORD.size
+
+# Default size of a segment before we start a new one
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+
+# Default group commit: fsync after this many records or this many seconds, whatever comes first
+DEFAULT_COMMIT_RECORDS = 1000
+DEFAULT_COMMIT_INTERVAL = 5
+
+# Number of records in a block of the segment index
+BLOCK_RECORDS = 4096
+
+# NumPy types of the RPDO types, see PROTOCOL-PDO.md
+TYPE_DTYPES = {
+    0: '?',  # CN_BOOL
+    1: 'u1',  # CN_UINT8
+    2: '<u2',  # CN_UINT16
+    3: '<u4',  # CN_UINT32
+    5: 'i1',  # CN_INT8
+    6: '<i2',  # CN_INT16
+    8: '<i8',  # CN_INT64
+}
+
+
+def record_dtype():
+    """Returns the NumPy type of a record."""
+
+    return np.dtype([
+        ('timestamp', '<f8'),
+        ('pdid', '<u2'),
+        ('length', 'u1'),
+        ('padding', 'V5'),
+        ('data', 'u1', (8,)),
+    ])
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError('Reading the notification log requires numpy. Install it with '
+                          '`pip install pycomfoconnect[recorder]`.')
+
+
+class NotificationLog(object):
+    """Appends the sensor notifications to rotating segment files with fixed-width records.
+
+    append only queues the record. A writer thread writes the records through a buffered file, and only calls fsync
+    after commit_records records or commit_interval seconds, so a burst of notifications shares a single fsync and a
+    slow disk never holds up the thread that reads from the bridge.
+
+    Next to every segment, we keep a sparse index with the time range and the record count of every sensor for each
+    block of block_records records. The index is rewritten every time a block is full and when the segment is closed,
+    so only the records after the last full block have to be scanned when the index lags behind."""
+
+    def __init__(self, directory: str, segment_size: int = DEFAULT_SEGMENT_SIZE,
+                 commit_records: int = DEFAULT_COMMIT_RECORDS, commit_interval: float = DEFAULT_COMMIT_INTERVAL,
+                 block_records: int = BLOCK_RECORDS):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.commit_records = commit_records
+        self.commit_interval = commit_interval
+        self.block_records = block_records
+
+        self._lock = threading.Lock()
+
+        # Records that the writer thread still has to write
+        self._condition = threading.Condition()
+        self._queue = collections.deque()
+        self._writing = False
+        self._stopping = False
+        self._writer = None
+
+        self._file = None
+        self._path = None
+        self._size = 0
+        self._uncommitted = 0
+        self._last_commit = time.monotonic()
+        self._sequence = None
+
+        # Index of the segment we are writing to
+        self._blocks = []
+        self._block = None
+
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def path(self) -> str:
+        """Path of the segment we are writing to."""
+
+        return self._path
+
+    def append(self, timestamp: float, pdid: int, data: bytes):
+        """Append the raw value of a sensor notification."""
+
+        if len(data) > 8:
+            _LOGGER.debug('Not recording sensor %d since its value is %d bytes', pdid, len(data))
+            return
+
+        record = RECORD.pack(timestamp, pdid, len(data), data)
+
+        with self._condition:
+            if self._writer is None:
+                self._stopping = False
+                self._writer = threading.Thread(target=self._writer_loop, name='NotificationLog', daemon=True)
+                self._writer.start()
+
+            self._queue.append((timestamp, pdid, record))
+            self._condition.notify()
+
+    def commit(self):
+        """Write the queued records and the index to disk."""
+
+        self._drain()
+
+        with self._lock:
+            if self._file is not None:
+                self._commit()
+                self._write_index()
+
+    def close(self):
+        """Write the queued records, stop the writer thread and close the segment."""
+
+        with self._condition:
+            writer = self._writer
+            self._stopping = True
+            self._condition.notify_all()
+
+        if writer is not None:
+            writer.join()
+
+        with self._condition:
+            self._writer = None
+
+        with self._lock:
+            self._close_segment()
+
+    def _drain(self):
+        """Wait until the writer thread has written all queued records."""
+
+        with self._condition:
+            while self._writer is not None and (self._queue or self._writing):
+                self._condition.wait()
+
+    def _writer_loop(self):
+        while True:
+            with self._condition:
+                if not self._queue and not self._stopping:
+                    # Wake up after the commit interval, so the last records of a burst get committed too
+                    self._condition.wait(self.commit_interval)
+
+                records = self._queue
+                self._queue = collections.deque()
+                stopping = self._stopping
+                self._writing = True
+
+            try:
+                with self._lock:
+                    for timestamp, pdid, record in records:
+                        self._write(timestamp, pdid, record)
+
+                    if self._uncommitted and (self._uncommitted >= self.commit_records or
+                                              time.monotonic() - self._last_commit >= self.commit_interval):
+                        self._commit()
+
+            except Exception:
+                _LOGGER.exception('Could not write to the notification log')
+
+            finally:
+                with self._condition:
+                    self._writing = False
+                    self._condition.notify_all()
+
+            if stopping and not records:
+                return
+
+    def _write(self, timestamp: float, pdid: int, record: bytes):
+        if self._file is None or self._size + RECORD_SIZE > self.segment_size:
+            self._rotate(timestamp)
+
+        self._file.write(record)
+        self._size += RECORD_SIZE
+        self._uncommitted += 1
+
+        # Update the index of the current block
+        block = self._block
+        if timestamp < block['start']:
+            block['start'] = timestamp
+        if timestamp > block['end']:
+            block['end'] = timestamp
+        block['count'] += 1
+        block['pdids'][pdid] = block['pdids'].get(pdid, 0) + 1
+
+        if block['count'] >= self.block_records:
+            self._seal_block()
+
+    def _commit(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._uncommitted = 0
+        self._last_commit = time.monotonic()
+
+    def _close_segment(self):
+        if self._file is None:
+            return
+
+        if self._block['count']:
+            self._seal_block()
+        else:
+            self._commit()
+            self._write_index()
+
+        self._file.close()
+        self._file = None
+
+    def _new_block(self, offset: int):
+        self._block = {'offset': offset, 'count': 0, 'start': float('inf'), 'end': float('-inf'), 'pdids': {}}
+
+    def _seal_block(self):
+        """Add the current block to the index and start a new one."""
+
+        block = self._block
+        self._blocks.append(block)
+        self._new_block(block['offset'] + block['count'])
+
+        # The index may only describe records that are on disk
+        self._commit()
+        self._write_index()
+
+    def _write_index(self):
+        """Replace the index of the current segment."""
+
+        write_index(self._path, self._blocks, self.block_records)
+
+    def _rotate(self, timestamp: float):
+        """Close the current segment and start a new one."""
+
+        self._close_segment()
+
+        if self._sequence is None:
+            # Continue after the segments that are already in the directory
+            existing = list_segments(self.directory)
+            self._sequence = int(os.path.basename(existing[-1])[:-len(SEGMENT_SUFFIX)]) if existing else 0
+
+        self._sequence += 1
+        self._path = os.path.join(self.directory, '%012d%s' % (self._sequence, SEGMENT_SUFFIX))
+        self._file = open(self._path, 'xb')
+        self._file.write(HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, RECORD_SIZE, timestamp))
+        self._size = HEADER.size
+        self._blocks = []
+        self._new_block(0)
+        self._commit()
+
+        # Make sure the new file survives a crash
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+        _LOGGER.debug('Started segment %s', self._path)
+
+
+def list_segments(directory: str) -> list:
+    """Returns the paths of the segments in a directory, oldest first."""
+
+    return sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit()
+    )
+
+
+def write_index(path: str, blocks: list, block_records: int = BLOCK_RECORDS):
+    """Write the index of a segment next to it."""
+
+    pdids = {}
+    for block in blocks:
+        for pdid, count in block['pdids'].items():
+            pdids[pdid] = pdids.get(pdid, 0) + count
+
+    index = {
+        'version': INDEX_VERSION,
+        'block_records': block_records,
+        'count': sum(block['count'] for block in blocks),
+        'start': min((block['start'] for block in blocks), default=None),
+        'end': max((block['end'] for block in blocks), default=None),
+        'pdids': {str(pdid): count for pdid, count in sorted(pdids.items())},
+        'blocks': [
+            {
+                'offset': block['offset'],
+                'count': block['count'],
+                'start': block['start'],
+                'end': block['end'],
+                'pdids': {str(pdid): count for pdid, count in sorted(block['pdids'].items())},
+            } for block in blocks
+        ],
+    }
+
+    # Replace the index atomically, so a reader never sees half of it
+    temp_path = path + INDEX_SUFFIX + '.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump(index, file, separators=(',', ':'))
+    os.replace(temp_path, path + INDEX_SUFFIX)
+
+
+def load_index(path: str) -> dict:
+    """Returns the index of a segment, or None if it has no index."""
+
+    try:
+        with open(path + INDEX_SUFFIX) as file:
+            index = json.load(file)
+    except (OSError, ValueError):
+        return None
+
+    if index.get('version') != INDEX_VERSION:
+        return None
+
+    return index
+
+
+def build_index(path: str, block_records: int = BLOCK_RECORDS):
+    """Build the index of a segment that was written without one."""
+
+    records = open_segment(path)
+
+    blocks = []
+    for offset in range(0, len(records), block_records):
+        block = records[offset:offset + block_records]
+        pdids, counts = np.unique(block['pdid'], return_counts=True)
+        blocks.append({
+            'offset': offset,
+            'count': len(block),
+            'start': float(block['timestamp'].min()),
+            'end': float(block['timestamp'].max()),
+            'pdids': dict(zip(pdids.tolist(), counts.tolist())),
+        })
+
+    write_index(path, blocks, block_records)
+
+
+def open_segment(path: str):
+    """Memory-map a segment and return its records as a structured NumPy array."""
+
+    _require_numpy()
+
+    with open(path, 'rb') as file:
+        magic, version, record_size, _ = HEADER.unpack(file.read(HEADER.size))
+
+    if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION or record_size != RECORD_SIZE:
+        raise Exception('%s is not a notification log segment' % path)
+
+    # Ignore a record that was only partly written when we crashed
+    count = (os.path.getsize(path) - HEADER.size) // RECORD_SIZE
+    if count == 0:
+        return np.empty(0, dtype=record_dtype())
+
+    return np.memmap(path, dtype=record_dtype(), mode='r', offset=HEADER.size, shape=(count,))
+
+
+def decode_values(records, sensor_type: int, divisor: int = 1):
+    """Convert the raw values of records of one sensor to a NumPy array of values."""
+
+    _require_numpy()
+
+    dtype = np.dtype(TYPE_DTYPES[sensor_type])
+    values = np.ascontiguousarray(records['data'][:, :dtype.itemsize]).view(dtype).reshape(-1)
+    if divisor != 1:
+        return values / divisor
+
+    return values
+
+
+class LogReader(object):
+    """Reads the segments written by a NotificationLog without creating a Python object per record."""
+
+    def __init__(self, directory: str, definitions: dict = None):
+        _require_numpy()
+
+        self.directory = directory
+
+        # The comfoconnect module imports us, so we can only import its definitions here
+        from .comfoconnect import SENSOR_DEFINITIONS
+
+        # Decode the known sensors, and the sensors that were registered with a custom type
+        self.definitions = dict(SENSOR_DEFINITIONS)
+        if definitions:
+            self.definitions.update(definitions)
+
+    def segments(self) -> list:
+        """Returns the paths of the segments, oldest first."""
+
+        return list_segments(self.directory)
+
+    def scan(self, start: float = None, end: float = None, pdids=None):
+        """Yields the records of every segment with start <= timestamp < end.
+
+        The index of the segments is used to skip the blocks without matching records, so only the pages of the
+        relevant blocks are read from disk. Without filters, the records are views on the memory-mapped file."""
+
+        if pdids is not None:
+            pdids = [int(pdid) for pdid in pdids]
+
+        for path in self.segments():
+            records = open_segment(path)
+            if not len(records):
+                continue
+
+            for chunk in self._select_blocks(records, load_index(path), start, end, pdids):
+                chunk = self._filter(chunk, start, end, pdids)
+                if len(chunk):
+                    yield chunk
+
+    @staticmethod
+    def _select_blocks(records, index, start, end, pdids):
+        """Yields the parts of a segment that can contain matching records."""
+
+        if index is None:
+            yield records
+            return
+
+        keys = None if pdids is None else [str(pdid) for pdid in pdids]
+
+        # Check the whole segment first
+        blocks = index['blocks']
+        if not index['count'] or (start is not None and index['end'] < start) or \
+                (end is not None and index['start'] >= end) or \
+                (keys is not None and not any(key in index['pdids'] for key in keys)):
+            blocks = []
+
+        # Merge adjacent blocks, so we return as few chunks as possible
+        begin = stop = None
+        for block in blocks:
+            if (start is not None and block['end'] < start) or (end is not None and block['start'] >= end) or \
+                    (keys is not None and not any(key in block['pdids'] for key in keys)):
+                continue
+
+            if block['offset'] != stop:
+                if begin is not None:
+                    yield records[begin:stop]
+                begin = block['offset']
+            stop = block['offset'] + block['count']
+
+        if begin is not None:
+            yield records[begin:stop]
+
+        # The records after the last indexed block always need to be scanned
+        if index['count'] < len(records):
+            yield records[index['count']:]
+
+    @staticmethod
+    def _filter(records, start, end, pdids):
+        mask = None
+        if start is not None:
+            mask = records['timestamp'] >= start
+        if end is not None:
+            mask = records['timestamp'] < end if mask is None else mask & (records['timestamp'] < end)
+        if pdids is not None:
+            selected = np.isin(records['pdid'], list(pdids))
+            mask = selected if mask is None else mask & selected
+
+        if mask is not None:
+            records = records[mask]
+
+        return records
+
+    def read(self, start: float = None, end: float = None, pdids=None):
+        """Returns all the records with start <= timestamp < end in a single array."""
+
+        chunks = list(self.scan(start, end, pdids))
+        if not chunks:
+            return np.empty(0, dtype=record_dtype())
+
+        return np.concatenate(chunks)
+
+    def sensor(self, pdid: int, start: float = None, end: float = None):
+        """Returns the timestamps and the decoded values of a sensor."""
+
+        records = self.read(start, end, [pdid])
+
+        definition = self.definitions.get(pdid)
+        if definition is None:
+            raise Exception('Reading sensor %d with unknown type' % pdid)
+
+        return records['timestamp'], decode_values(records, definition.type, definition.divisor)
@@ -0,0 +1,98 @@
+import struct
+
+# Struct formats of the RPDO types, see PROTOCOL-PDO.md
+TYPE_FORMATS = {
+    0: '<?',  # CN_BOOL
+    1: '<B',  # CN_UINT8
+    2: '<H',  # CN_UINT16
+    3: '<L',  # CN_UINT32
+    5: '<b',  # CN_INT8
+    6: '<h',  # CN_INT16
+    8: '<q',  # CN_INT64
+}
+
+# Divisor and unit of the known sensors, see PROTOCOL-PDO.md
+SENSOR_UNITS = {
+    81: (1, 's'),
+    117: (1, '%'),
+    118: (1, '%'),
+    119: (1, 'm³/h'),
+    120: (1, 'm³/h'),
+    121: (1, 'rpm'),
+    122: (1, 'rpm'),
+    128: (1, 'W'),
+    129: (1, 'kWh'),
+    130: (1, 'kWh'),
+    144: (1, 'kWh'),
+    145: (1, 'kWh'),
+    146: (1, 'W'),
+    192: (1, 'days'),
+    209: (10, '°C'),
+    212: (10, '°C'),
+    213: (100, 'W'),
+    214: (1, 'kWh'),
+    215: (1, 'kWh'),
+    216: (100, 'W'),
+    217: (1, 'kWh'),
+    218: (1, 'kWh'),
+    221: (10, '°C'),
+    227: (1, '%'),
+    274: (10, '°C'),
+    275: (10, '°C'),
+    276: (10, '°C'),
+    277: (10, '°C'),
+    278: (10, '°C'),
+    290: (1, '%'),
+    291: (1, '%'),
+    292: (1, '%'),
+    293: (1, '%'),
+    294: (1, '%'),
+    416: (10, '°C'),
+    417: (10, '°C'),
+}
+
+
+class SensorDefinition(object):
+    """Describes how the payload of a sensor is decoded."""
+
+    __slots__ = ('pdid', 'type', 'struct', 'signed', 'divisor', 'unit', 'decode')
+
+    def __init__(self, pdid: int, sensor_type: int, divisor: int = 1, unit: str = None):
+        self.pdid = pdid
+        self.type = sensor_type
+        self.struct = struct.Struct(TYPE_FORMATS[sensor_type])
+        self.signed = self.struct.format[-1] in 'bhq'
+        self.divisor = divisor
+        self.unit = unit
+
+        # Compile the decoder once, so decoding is a single unpack_from
+        unpack_from = self.struct.unpack_from
+        if divisor != 1:
+            self.decode = lambda data: unpack_from(data)[0] / divisor
+        else:
+            self.decode = lambda data: unpack_from(data)[0]
+
+    @property
+    def scale(self):
+        """Factor to convert the raw value to the unit."""
+
+        return 1 / self.divisor
+
+    def __repr__(self):
+        return 'SensorDefinition(pdid=%d, type=%d, divisor=%d, unit=%r)' % (
+            self.pdid, self.type, self.divisor, self.unit
+        )
+
+
+def build_sensor_definitions(type_map: dict) -> dict:
+    """Build a SensorDefinition for every sensor in the type map that has a known type."""
+
+    definitions = {}
+    for pdid, sensor_type in type_map.items():
+        if sensor_type not in TYPE_FORMATS:
+            continue
+
+        divisor, unit = SENSOR_UNITS.get(pdid, (1, None))
+        definitions[pdid] = SensorDefinition(pdid, sensor_type, divisor, unit)
+
+    return definitions
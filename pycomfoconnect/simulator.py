@@ -0,0 +1,450 @@
+"""
+Simulates a ComfoConnect LAN C bridge, so the library can be tested and load-tested without a ventilation unit.
+
+Usage:
+  $ python3 -m pycomfoconnect.simulator --port 56747 --rate 100 --latency 0.01
+"""
+import argparse
+import asyncio
+import logging
+import math
+import random
+import struct
+import threading
+import time
+
+from . import codec
+from .bridge import Bridge
+from .comfoconnect import RPDO_TYPE_MAP, SENSOR_DEFINITIONS
+from .message import *
+from .sensors import TYPE_FORMATS
+
+_LOGGER = logging.getLogger('simulator')
+
+DEFAULT_SIMULATOR_UUID = bytes.fromhex('0000000000251010800170b3d54264b4')
+
+# Seconds between 1970-01-01 and 2000-01-01, the epoch of the ComfoNet time
+COMFONET_EPOCH = 946684800
+
+# Version information the simulator reports
+GATEWAY_VERSION = 1049610
+COMFONET_VERSION = 4100
+SERIAL_NUMBER = 'DEM0116371401'
+
+
+def default_values(pdid: int, sensor_type: int, tick: int) -> int:
+    """Returns a raw value for a sensor that slowly moves around a fixed level."""
+
+    if sensor_type == 0:
+        return (tick // 10) % 2
+
+    definition = SENSOR_DEFINITIONS.get(pdid)
+    divisor = definition.divisor if definition else 1
+    return int((50 + 25 * math.sin(tick / 20 + pdid)) * divisor)
+
+
+def default_rmi(node_id: int, message: bytes) -> bytes:
+    """Answers every RMI request with an empty response."""
+
+    return b''
+
+
+class _Session(object):
+    """State of a client that is connected to the simulator."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.uuid = None
+        self.devicename = None
+        self.logged_in = False
+        self.sensors = {}
+        self.tick = 0
+        self.reply_after = 0
+        self.notify_task = None
+
+
+class BridgeSimulator(object):
+    """Simulates a ComfoConnect LAN C bridge on TCP and UDP.
+
+    rate: number of notifications per second for every registered sensor, or None to only send the first value.
+    latency, jitter: delay the replies latency seconds, plus a random delay up to jitter seconds.
+    values: function that returns the raw value of a sensor for a tick, as values(pdid, sensor_type, tick).
+    rmi_handler: function that returns the response to an RMI request, as rmi_handler(node_id, message).
+    """
+
+    def __init__(self, host: str = '0.0.0.0', port: int = Bridge.PORT, uuid: bytes = DEFAULT_SIMULATOR_UUID,
+                 pin: int = 0, rate: float = 1.0, latency: float = 0, jitter: float = 0,
+                 advertise_host: str = '127.0.0.1', values=default_values, rmi_handler=default_rmi,
+                 discovery: bool = True):
+        self.host = host
+        self.port = port
+        self.uuid = uuid
+        self.pin = pin
+        self.rate = rate
+        self.latency = latency
+        self.jitter = jitter
+        self.advertise_host = advertise_host
+        self.values = values
+        self.rmi_handler = rmi_handler
+        self.discovery = discovery
+
+        # Registered apps by uuid, and the session that is logged in
+        self.apps = {}
+        self._active = None
+        self._sessions = set()
+        self._tasks = set()
+
+        self._server = None
+        self._transport = None
+        self._loop = None
+        self._thread = None
+
+        # Counters
+        self.connections = 0
+        self.requests = 0
+        self.notifications = 0
+
+    def stats(self) -> dict:
+        """Returns the counters of the simulator."""
+
+        return {
+            'connections': self.connections,
+            'sessions': len(self._sessions),
+            'requests': self.requests,
+            'notifications': self.notifications,
+        }
+
+    # ==================================================================================================================
+    # Server
+    # ==================================================================================================================
+
+    async def start(self):
+        """Start listening. With port 0, a free port is picked and stored in port."""
+
+        self._loop = asyncio.get_running_loop()
+        self._server = await asyncio.start_server(self._handle_client, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+        if self.discovery:
+            self._transport, _ = await self._loop.create_datagram_endpoint(
+                lambda: _DiscoveryResponder(self),
+                local_addr=(self.host, self.port),
+                allow_broadcast=True
+            )
+
+        _LOGGER.info('Simulating a bridge on port %d', self.port)
+
+    async def stop(self):
+        """Stop listening and disconnect all clients."""
+
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+
+        if self._server is not None:
+            self._server.close()
+            for session in list(self._sessions):
+                self._close_session(session)
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+
+    async def serve_forever(self):
+        """Start listening and run until we are cancelled."""
+
+        await self.start()
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.stop()
+
+    def start_background(self):
+        """Run the simulator in its own event loop in a background thread."""
+
+        started = threading.Event()
+
+        def run():
+            loop = asyncio.new_event_loop()
+            loop.run_until_complete(self.start())
+            started.set()
+            loop.run_forever()
+            loop.run_until_complete(self.stop())
+            loop.close()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+
+    def stop_background(self):
+        """Stop the simulator that runs in a background thread."""
+
+        if self._thread is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._thread = None
+
+    # ==================================================================================================================
+    # Sessions
+    # ==================================================================================================================
+
+    async def _handle_client(self, reader, writer):
+        session = _Session(writer)
+        self._sessions.add(session)
+        self._tasks.add(asyncio.current_task())
+        self.connections += 1
+
+        try:
+            while True:
+                msg_len_buf = await reader.readexactly(4)
+                msg_buf = await reader.readexactly(struct.unpack('>L', msg_len_buf)[0])
+                self._handle_request(session, Message.decode(msg_len_buf + msg_buf))
+
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+        except asyncio.CancelledError:
+            # We are stopping
+            pass
+
+        finally:
+            self._close_session(session)
+            self._tasks.discard(asyncio.current_task())
+
+    def _close_session(self, session: _Session):
+        if session.notify_task is not None:
+            session.notify_task.cancel()
+            session.notify_task = None
+
+        if self._active is session:
+            self._active = None
+
+        self._sessions.discard(session)
+        session.writer.close()
+
+    def _reply(self, session: _Session, request: Message, confirm, result=GatewayOperation.OK, params=None):
+        """Send the confirm of a request after the configured latency."""
+
+        reply = Message.create(
+            self.uuid,
+            request.src,
+            confirm,
+            {'reference': request.cmd.reference, 'result': result}
+        )
+        for param, value in (params or {}).items():
+            if isinstance(value, list):
+                getattr(reply.msg, param).extend(value)
+            else:
+                setattr(reply.msg, param, value)
+        packet = reply.encode()
+
+        delay = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0)
+        if not delay:
+            session.writer.write(packet)
+            return
+
+        # Replies never overtake each other, like on a real TCP connection
+        now = self._loop.time()
+        session.reply_after = max(session.reply_after, now + delay)
+        self._loop.call_at(session.reply_after, self._write, session, packet)
+
+    @staticmethod
+    def _write(session: _Session, packet: bytes):
+        if not session.writer.is_closing():
+            session.writer.write(packet)
+
+    def _handle_request(self, session: _Session, message: Message):
+        self.requests += 1
+        cmd_type = message.cmd.type
+        command = Message.request_type_to_class_mapping.get(cmd_type)
+        confirm = Message.class_to_confirm.get(command)
+
+        if cmd_type == GatewayOperation.RegisterAppRequestType:
+            if message.msg.pin != self.pin:
+                self._reply(session, message, confirm, GatewayOperation.NOT_ALLOWED)
+                return
+            self.apps[message.msg.uuid] = message.msg.devicename
+            self._reply(session, message, confirm)
+
+        elif cmd_type == GatewayOperation.StartSessionRequestType:
+            if message.src not in self.apps:
+                self._reply(session, message, confirm, GatewayOperation.NOT_ALLOWED)
+                return
+
+            active = self._active
+            if active is not None and active is not session:
+                if not message.msg.takeover:
+                    self._reply(session, message, confirm, GatewayOperation.OTHER_SESSION,
+                                {'devicename': active.devicename})
+                    return
+
+                # Ask the other client to leave
+                self._write(active, Message.create(self.uuid, active.uuid, CloseSessionRequest).encode())
+                self._close_session(active)
+
+            session.uuid = message.src
+            session.devicename = self.apps[message.src]
+            session.logged_in = True
+            self._active = session
+            self._reply(session, message, confirm)
+
+        elif cmd_type == GatewayOperation.KeepAliveType:
+            pass
+
+        elif not session.logged_in:
+            if confirm is not None:
+                self._reply(session, message, confirm, GatewayOperation.NOT_ALLOWED)
+
+        elif cmd_type == GatewayOperation.CloseSessionRequestType:
+            self._reply(session, message, confirm)
+            self._close_session(session)
+
+        elif cmd_type == GatewayOperation.ListRegisteredAppsRequestType:
+            self._reply(session, message, confirm, params={
+                'apps': [ListRegisteredAppsConfirm.App(uuid=uuid, devicename=name) for uuid, name in self.apps.items()]
+            })
+
+        elif cmd_type == GatewayOperation.DeregisterAppRequestType:
+            if self.apps.pop(message.msg.uuid, None) is None:
+                self._reply(session, message, confirm, GatewayOperation.BAD_REQUEST)
+            else:
+                self._reply(session, message, confirm)
+
+        elif cmd_type == GatewayOperation.VersionRequestType:
+            self._reply(session, message, confirm, params={
+                'gatewayVersion': GATEWAY_VERSION,
+                'serialNumber': SERIAL_NUMBER,
+                'comfoNetVersion': COMFONET_VERSION,
+            })
+
+        elif cmd_type == GatewayOperation.CnTimeRequestType:
+            self._reply(session, message, confirm, params={'currentTime': int(time.time()) - COMFONET_EPOCH})
+
+        elif cmd_type == GatewayOperation.CnRmiRequestType:
+            try:
+                response = self.rmi_handler(message.msg.nodeId, message.msg.message)
+            except Exception:
+                _LOGGER.exception('RMI handler failed')
+                self._reply(session, message, confirm, GatewayOperation.RMI_ERROR)
+                return
+            self._reply(session, message, confirm, params={'message': response})
+
+        elif cmd_type == GatewayOperation.CnRpdoRequestType:
+            self._handle_rpdo_request(session, message, confirm)
+
+        elif confirm is not None:
+            self._reply(session, message, confirm)
+
+    def _handle_rpdo_request(self, session: _Session, message: Message, confirm):
+        pdid = message.msg.pdid
+        sensor_type = message.msg.type if message.msg.HasField('type') else RPDO_TYPE_MAP.get(pdid)
+
+        if sensor_type not in TYPE_FORMATS:
+            self._reply(session, message, confirm, GatewayOperation.BAD_REQUEST)
+            return
+
+        self._reply(session, message, confirm)
+
+        if message.msg.timeout == 0:
+            # Unregister
+            session.sensors.pop(pdid, None)
+            return
+
+        session.sensors[pdid] = struct.Struct(TYPE_FORMATS[sensor_type]), sensor_type
+
+        # The bridge sends the current value right away
+        session.writer.write(self._notification(session, pdid, session.tick))
+
+        if self.rate and session.notify_task is None:
+            session.notify_task = self._loop.create_task(self._notify_loop(session))
+
+    def _notification(self, session: _Session, pdid: int, tick: int) -> bytes:
+        """Build the frame of a RPDO notification."""
+
+        sensor_struct, sensor_type = session.sensors[pdid]
+        raw = self.values(pdid, sensor_type, tick)
+        try:
+            data = sensor_struct.pack(raw)
+        except struct.error:
+            data = sensor_struct.pack(0)
+
+        msg_buf = codec.RpdoNotification(pdid, data).SerializeToString()
+        self.notifications += 1
+
+        return struct.pack('>L', 34 + len(_RPDO_CMD) + len(msg_buf)) + self.uuid + session.uuid + _RPDO_CMD_LEN + \
+            _RPDO_CMD + msg_buf
+
+    async def _notify_loop(self, session: _Session):
+        """Send the notifications of the registered sensors at the configured rate."""
+
+        interval = 1 / self.rate
+        next_tick = self._loop.time() + interval
+
+        while True:
+            await asyncio.sleep(max(next_tick - self._loop.time(), 0))
+
+            # Catch up with all the ticks that are due, and send them in a single write
+            due = int((self._loop.time() - next_tick) / interval) + 1
+            frames = []
+            for _ in range(due):
+                session.tick += 1
+                for pdid in list(session.sensors):
+                    frames.append(self._notification(session, pdid, session.tick))
+            next_tick += due * interval
+
+            if frames:
+                session.writer.write(b''.join(frames))
+                await session.writer.drain()
+
+
+# The header of a RPDO notification is always the same
+_RPDO_CMD = GatewayOperation(type=GatewayOperation.CnRpdoNotificationType).SerializeToString()
+_RPDO_CMD_LEN = struct.pack('>H', len(_RPDO_CMD))
+
+
+class _DiscoveryResponder(asyncio.DatagramProtocol):
+    """Answers the discovery broadcasts."""
+
+    def __init__(self, simulator: BridgeSimulator):
+        self._simulator = simulator
+        self._transport = None
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def datagram_received(self, data, addr):
+        if data != b"\x0a\x00":
+            return
+
+        response = DiscoveryOperation()
+        response.searchGatewayResponse.ipaddress = self._simulator.advertise_host
+        response.searchGatewayResponse.uuid = self._simulator.uuid
+        response.searchGatewayResponse.version = 1
+        self._transport.sendto(response.SerializeToString(), addr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Simulate a ComfoConnect LAN C bridge.')
+    parser.add_argument('--host', default='0.0.0.0', help='address to listen on')
+    parser.add_argument('--port', type=int, default=Bridge.PORT, help='TCP and UDP port to listen on')
+    parser.add_argument('--advertise', default='127.0.0.1', help='address to report in the discovery responses')
+    parser.add_argument('--pin', type=int, default=0, help='PIN that apps need to register')
+    parser.add_argument('--rate', type=float, default=1.0, help='notifications per second for every sensor')
+    parser.add_argument('--latency', type=float, default=0, help='delay of the replies in seconds')
+    parser.add_argument('--jitter', type=float, default=0, help='random extra delay of the replies in seconds')
+    parser.add_argument('--debug', action='store_true', help='show debug output')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+
+    simulator = BridgeSimulator(args.host, args.port, pin=args.pin, rate=args.rate or None, latency=args.latency,
+                                jitter=args.jitter, advertise_host=args.advertise)
+    try:
+        asyncio.run(simulator.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
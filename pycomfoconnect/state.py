@@ -0,0 +1,44 @@
+from collections import namedtuple
+
+# Latest known state of a sensor
+SensorState = namedtuple('SensorState', ['value', 'timestamp', 'count'])
+
+
+class SensorStateCache(object):
+    """Keeps the latest value of every sensor.
+
+    Only the message thread writes to the cache, and it always replaces a complete SensorState, so readers in other
+    threads never need a lock."""
+
+    def __init__(self):
+        self._states = {}
+
+    def update(self, pdid: int, value, timestamp: float) -> SensorState:
+        """Store a new value for a sensor."""
+
+        previous = self._states.get(pdid)
+        state = SensorState(value, timestamp, previous.count + 1 if previous else 1)
+        self._states[pdid] = state
+
+        return state
+
+    def get(self, pdid: int, default=None) -> SensorState:
+        """Returns the latest state of a sensor."""
+
+        return self._states.get(pdid, default)
+
+    def snapshot(self) -> dict:
+        """Returns a consistent copy of the state of all sensors."""
+
+        return self._states.copy()
+
+    def clear(self):
+        """Forget all values."""
+
+        self._states = {}
+
+    def __contains__(self, pdid):
+        return pdid in self._states
+
+    def __len__(self):
+        return len(self._states)
@@ -0,0 +1,72 @@
+import threading
+
+
+class Subscription(object):
+    """Handle of a handler that subscribed to one or more sensors."""
+
+    def __init__(self, owner, sensor_ids, handler):
+        self._owner = owner
+        self.sensor_ids = frozenset(sensor_ids)
+        self.handler = handler
+        self.active = True
+
+    def unsubscribe(self):
+        """Stop receiving updates for these sensors."""
+
+        self._owner.unsubscribe(self)
+
+    def __repr__(self):
+        return 'Subscription(sensor_ids=%s, active=%s)' % (sorted(self.sensor_ids), self.active)
+
+
+class SubscriptionRegistry(object):
+    """Keeps track of the handlers that subscribed to every sensor.
+
+    The handlers of a sensor are stored as a tuple that is replaced on every change, so the message thread can look
+    them up without taking a lock."""
+
+    def __init__(self):
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+
+    def add(self, subscription: Subscription) -> list:
+        """Add a subscription and return the sensors that got their first subscriber."""
+
+        first = []
+        with self._lock:
+            for sensor_id in subscription.sensor_ids:
+                subscriptions = self._subscriptions.get(sensor_id, ())
+                if not subscriptions:
+                    first.append(sensor_id)
+                self._subscriptions[sensor_id] = subscriptions + (subscription,)
+
+        return first
+
+    def remove(self, subscription: Subscription) -> list:
+        """Remove a subscription and return the sensors that lost their last subscriber."""
+
+        last = []
+        with self._lock:
+            for sensor_id in subscription.sensor_ids:
+                subscriptions = tuple(s for s in self._subscriptions.get(sensor_id, ()) if s is not subscription)
+                if subscriptions:
+                    self._subscriptions[sensor_id] = subscriptions
+                elif self._subscriptions.pop(sensor_id, None) is not None:
+                    last.append(sensor_id)
+
+        return last
+
+    def get(self, sensor_id: int) -> tuple:
+        """Returns the subscriptions of a sensor."""
+
+        return self._subscriptions.get(sensor_id, ())
+
+    def count(self, sensor_id: int) -> int:
+        """Returns the number of subscriptions of a sensor."""
+
+        return len(self._subscriptions.get(sensor_id, ()))
+
+    def sensor_ids(self) -> list:
+        """Returns the sensors that have at least one subscriber."""
+
+        return list(self._subscriptions)
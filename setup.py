@@ -17,6 +17,10 @@ setup(
     include_package_data=True,
     platforms='any',
     install_requires=list(val.strip() for val in open('requirements.txt')),
+    extras_require={
+        'history': ['numpy'],
+        'recorder': ['numpy'],
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         'Intended Audience :: Developers',
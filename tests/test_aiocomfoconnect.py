@@ -0,0 +1,108 @@
+"""
+Check the notification streams of the asyncio client and the bridge pool against the simulated bridge.
+"""
+import asyncio
+
+from pycomfoconnect import AsyncBridge, AsyncComfoConnect, BridgePool, BridgeSimulator
+
+SENSOR = 221
+
+
+async def collect(iterator, items):
+    async for item in iterator:
+        items.append(item)
+
+
+def test_notifications_every_iterator():
+    async def main():
+        simulator = BridgeSimulator(host='127.0.0.1', port=0, rate=20, discovery=False)
+        await simulator.start()
+
+        client = AsyncComfoConnect(AsyncBridge('127.0.0.1', simulator.uuid, simulator.port))
+        first, second = [], []
+        try:
+            await client.connect()
+            tasks = [asyncio.ensure_future(collect(client.notifications(), items)) for items in (first, second)]
+            await asyncio.sleep(0)
+            await client.register_sensor(SENSOR)
+            await asyncio.sleep(0.5)
+
+            # Both iterators end when the connection is closed
+            await client.disconnect()
+            await asyncio.wait_for(asyncio.gather(*tasks), 1)
+
+        finally:
+            await simulator.stop()
+
+        return first, second
+
+    first, second = asyncio.run(main())
+
+    # Every iterator gets all updates
+    assert first
+    assert first == second
+
+
+def test_notifications_after_reconnect():
+    async def main():
+        simulator = BridgeSimulator(host='127.0.0.1', port=0, rate=20, discovery=False)
+        await simulator.start()
+
+        client = AsyncComfoConnect(AsyncBridge('127.0.0.1', simulator.uuid, simulator.port))
+        items = []
+        try:
+            # Nobody iterates over the first session
+            await client.connect()
+            await client.register_sensor(SENSOR)
+            await asyncio.sleep(0.2)
+            await client.disconnect()
+
+            # The end of the first session doesn't end the iterator of the next one
+            await client.connect()
+            task = asyncio.ensure_future(collect(client.notifications(), items))
+            await asyncio.sleep(0.5)
+            assert not task.done()
+
+            await client.disconnect()
+            await asyncio.wait_for(task, 1)
+
+        finally:
+            await simulator.stop()
+
+        return items
+
+    assert asyncio.run(main())
+
+
+def test_pool_notifications_after_restart():
+    async def main():
+        simulator = BridgeSimulator(host='127.0.0.1', port=0, rate=20, discovery=False)
+        await simulator.start()
+
+        pool = BridgePool()
+        pool.add(AsyncBridge('127.0.0.1', simulator.uuid, simulator.port), sensors=[SENSOR])
+        first, second = [], []
+        try:
+            # Nobody iterates while the pool runs the first time
+            await pool.start()
+            await asyncio.sleep(0.2)
+            await pool.stop()
+
+            # The stop of the first run doesn't end the iterators of the next one
+            await pool.start()
+            tasks = [asyncio.ensure_future(collect(pool.notifications(), items)) for items in (first, second)]
+            await asyncio.sleep(0.5)
+            assert not any(task.done() for task in tasks)
+
+            await pool.stop()
+            await asyncio.wait_for(asyncio.gather(*tasks), 1)
+
+        finally:
+            await simulator.stop()
+
+        return first, second
+
+    first, second = asyncio.run(main())
+
+    assert first
+    assert first == second
@@ -0,0 +1,189 @@
+"""
+Check that the hand-written codec is byte-for-byte equivalent to the generated protobuf classes.
+
+The codec is only enabled on the pure-Python protobuf implementation, so these tests force it on.
+"""
+import random
+
+import pytest
+
+from pycomfoconnect import codec
+from pycomfoconnect.message import Message
+from pycomfoconnect.zehnder_pb2 import GatewayOperation, CnRpdoNotification, CnTimeRequest, KeepAlive
+
+ITERATIONS = 2000
+
+LOCAL_UUID = bytes.fromhex('00000000000000000000000000001337')
+BRIDGE_UUID = bytes.fromhex('0000000000251010800170b3d54264b4')
+
+OPERATION_TYPES = sorted(GatewayOperation.OperationType.values())
+GATEWAY_RESULTS = sorted(GatewayOperation.GatewayResult.values())
+
+
+@pytest.fixture
+def rng():
+    return random.Random(1337)
+
+
+@pytest.fixture
+def enabled(monkeypatch):
+    monkeypatch.setattr(codec, 'ENABLED', True)
+
+
+def random_uint32(rng):
+    # Prefer small values, but also cover every varint length
+    return rng.choice([rng.randrange(0x80), rng.randrange(0x4000), rng.randrange(1 << 32)])
+
+
+def random_text(rng):
+    alphabet = 'abcXYZ 019\n\t"\'\\\x00\x7f' + 'éß€'
+    return ''.join(rng.choice(alphabet) for _ in range(rng.randrange(20)))
+
+
+def random_header_fields(rng):
+    fields = {
+        'type': rng.choice(OPERATION_TYPES),
+        'result': rng.choice(GATEWAY_RESULTS),
+        'resultDescription': random_text(rng),
+        'reference': random_uint32(rng),
+    }
+
+    # Leave out a random selection of the fields
+    return {name: value for name, value in fields.items() if rng.random() < 0.7}
+
+
+def protobuf_header(fields):
+    header = GatewayOperation()
+    for name, value in fields.items():
+        setattr(header, name, value)
+    return header
+
+
+def assert_same_header(header, expected):
+    for name in ('type', 'result', 'resultDescription', 'reference'):
+        assert header.HasField(name) == expected.HasField(name), name
+        assert getattr(header, name) == getattr(expected, name), name
+
+    assert header.SerializeToString() == expected.SerializeToString()
+    assert str(header) == str(expected)
+
+
+# ======================================================================================================================
+# GatewayOperation header
+# ======================================================================================================================
+
+def test_gateway_header_encode(rng):
+    for _ in range(ITERATIONS):
+        fields = random_header_fields(rng)
+        assert codec.GatewayHeader(**fields).SerializeToString() == protobuf_header(fields).SerializeToString()
+
+
+def test_gateway_header_decode(rng):
+    for _ in range(ITERATIONS):
+        expected = protobuf_header(random_header_fields(rng))
+        header = codec.decode_gateway_operation(expected.SerializeToString())
+
+        assert header is not None
+        assert_same_header(header, expected)
+
+
+def test_gateway_header_fallback():
+    # Unknown field
+    assert codec.decode_gateway_operation(b'\x28\x01') is None
+    # Unknown operation type
+    assert codec.decode_gateway_operation(b'\x08\x7f') is None
+    # Truncated varint and truncated string
+    assert codec.decode_gateway_operation(b'\x20\xff') is None
+    assert codec.decode_gateway_operation(b'\x1a\x05abc') is None
+
+
+# ======================================================================================================================
+# CnRpdoNotification
+# ======================================================================================================================
+
+def random_rpdo(rng):
+    message = CnRpdoNotification()
+    message.pdid = random_uint32(rng)
+    message.data = bytes(rng.randrange(256) for _ in range(rng.randrange(9)))
+    return message
+
+
+def test_rpdo_notification_encode(rng):
+    for _ in range(ITERATIONS):
+        expected = random_rpdo(rng)
+        notification = codec.RpdoNotification(expected.pdid, expected.data)
+
+        assert notification.SerializeToString() == expected.SerializeToString()
+
+
+def test_rpdo_notification_decode(rng):
+    for _ in range(ITERATIONS):
+        expected = random_rpdo(rng)
+        notification = codec.decode_rpdo_notification(expected.SerializeToString())
+
+        assert notification is not None
+        assert notification.pdid == expected.pdid
+        assert notification.data == expected.data
+        assert notification.SerializeToString() == expected.SerializeToString()
+        assert str(notification) == str(expected)
+
+
+def test_rpdo_notification_fallback():
+    # Missing required field
+    assert codec.decode_rpdo_notification(b'\x08\x01') is None
+    # Unknown field
+    assert codec.decode_rpdo_notification(b'\x08\x01\x12\x00\x18\x01') is None
+    # Truncated data
+    assert codec.decode_rpdo_notification(b'\x08\x01\x12\x04\x00') is None
+
+
+# ======================================================================================================================
+# KeepAlive
+# ======================================================================================================================
+
+def test_keepalive():
+    expected = KeepAlive()
+
+    assert codec.KeepAliveMessage().SerializeToString() == expected.SerializeToString()
+    assert str(codec.decode_keepalive(expected.SerializeToString())) == str(expected)
+    assert codec.decode_keepalive(b'\x08\x01') is None
+
+
+# ======================================================================================================================
+# Message
+# ======================================================================================================================
+
+def test_message_decode(rng, enabled):
+    for _ in range(ITERATIONS):
+        expected = random_rpdo(rng)
+        packet = Message.create(BRIDGE_UUID, LOCAL_UUID, CnRpdoNotification, {'reference': random_uint32(rng)},
+                                {'pdid': expected.pdid, 'data': expected.data}).encode()
+
+        message = Message.decode(packet)
+
+        # Make sure we went through the codec and not through protobuf
+        assert isinstance(message.cmd, codec.GatewayHeader)
+        assert isinstance(message.msg, codec.RpdoNotification)
+
+        assert message.cmd.type == GatewayOperation.CnRpdoNotificationType
+        assert message.msg.pdid == expected.pdid
+        assert message.msg.data == expected.data
+        assert message.encode() == packet
+
+
+def test_message_decode_keepalive(enabled):
+    packet = Message.create(LOCAL_UUID, BRIDGE_UUID, KeepAlive).encode()
+    message = Message.decode(packet)
+
+    assert isinstance(message.msg, codec.KeepAliveMessage)
+    assert message.encode() == packet
+
+
+def test_message_decode_fallback(enabled):
+    # Messages without a fast decoder are parsed by protobuf
+    packet = Message.create(LOCAL_UUID, BRIDGE_UUID, CnTimeRequest, {'reference': 42}).encode()
+    message = Message.decode(packet)
+
+    assert isinstance(message.msg, CnTimeRequest)
+    assert message.cmd.reference == 42
+    assert message.encode() == packet
@@ -0,0 +1,154 @@
+"""
+Check the request handling of the client against the simulated bridge.
+"""
+import errno
+import threading
+import time
+
+import pytest
+
+from pycomfoconnect import Bridge, BridgeSimulator, ComfoConnect, MinInterval, ReconnectStrategy
+
+# The simulator answers every RMI request with an empty response
+RMI_SERIAL_NUMBER = b'\x01\x01\x01\x10\x08'
+
+# More sensors than fit in the window of outstanding requests
+SENSORS = [117, 118, 119, 120, 121, 122, 128, 129, 130, 144, 145, 146]
+
+
+@pytest.fixture
+def simulator():
+    simulator = BridgeSimulator(host='127.0.0.1', port=0, rate=None, discovery=False)
+    simulator.start_background()
+    yield simulator
+    simulator.stop_background()
+
+
+@pytest.fixture
+def client(simulator):
+    client = ComfoConnect(Bridge('127.0.0.1', simulator.uuid, simulator.port),
+                          reconnect=ReconnectStrategy(max_attempts=0))
+    client.connect()
+    yield client
+    if client._connection_thread is not None:
+        client.disconnect()
+
+
+# ======================================================================================================================
+# Window of outstanding requests
+# ======================================================================================================================
+
+def test_batch(client):
+    replies = client.cmd_rmi_request_batch([RMI_SERIAL_NUMBER] * 20)
+
+    assert len(replies) == 20
+
+
+def test_batch_timeout_includes_window(simulator, client):
+    # Only the first requests fit in the window, the others have to wait for their replies
+    simulator.latency = 5
+
+    start = time.monotonic()
+    with pytest.raises(ValueError):
+        client.cmd_rmi_request_batch([RMI_SERIAL_NUMBER] * 20, timeout=1)
+
+    assert time.monotonic() - start < 2
+
+    # The requests we gave up on don't keep their slot in the window
+    assert not client._pending
+
+
+def test_pending_requests_fail_on_disconnect(simulator, client):
+    simulator.latency = 5
+    errors = []
+
+    def request():
+        start = time.monotonic()
+        try:
+            client.cmd_time_request()
+        except Exception as exc:
+            errors.append((exc, time.monotonic() - start))
+
+    thread = threading.Thread(target=request)
+    thread.start()
+    time.sleep(0.2)
+
+    client.disconnect()
+    thread.join()
+
+    # The request doesn't wait for its timeout once nobody reads the replies anymore
+    assert len(errors) == 1
+    assert isinstance(errors[0][0], BrokenPipeError)
+    assert errors[0][1] < 3
+
+
+# ======================================================================================================================
+# Sensors
+# ======================================================================================================================
+
+def test_register_sensors(client):
+    assert client.register_sensors(SENSORS) == {sensor_id: True for sensor_id in SENSORS}
+    assert sorted(client.sensors) == SENSORS
+
+
+def test_register_sensors_timeout(simulator, client, monkeypatch):
+    # The bridge never confirms the registrations
+    monkeypatch.setattr(simulator, '_handle_rpdo_request', lambda *args: None)
+
+    start = time.monotonic()
+    results = client.register_sensors(SENSORS, timeout=1)
+
+    # The timeout applies to the whole batch, including the sensors that had to wait for room in the window
+    assert time.monotonic() - start < 2
+    assert results == {sensor_id: False for sensor_id in SENSORS}
+    assert not client.sensors
+
+
+def test_policy_min_interval(simulator, client):
+    simulator.rate = 50
+    updates = []
+    client.callback_sensor = lambda sensor_id, value: updates.append(time.monotonic())
+
+    client.register_sensor(221, policy=MinInterval(0.3))
+    time.sleep(1.1)
+
+    # The held back updates are passed on when the interval has passed, and not earlier
+    assert 3 <= len(updates) <= 5
+    assert min(later - earlier for earlier, later in zip(updates, updates[1:])) >= 0.25
+
+
+# ======================================================================================================================
+# Connection
+# ======================================================================================================================
+
+class BrokenSocket(object):
+    """Wraps a socket of which the connection breaks as soon as we send something."""
+
+    def __init__(self, sock):
+        self._sock = sock
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+    def sendall(self, data):
+        raise BrokenPipeError(errno.EPIPE, 'Broken pipe')
+
+
+def test_reconnect_after_failed_keepalive(simulator):
+    client = ComfoConnect(Bridge('127.0.0.1', simulator.uuid, simulator.port), keepalive=0.5, dead_peer_timeout=0)
+    client.connect()
+
+    try:
+        # The next keepalive fails, and closes the connection
+        client._bridge._socket = BrokenSocket(client._bridge._socket)
+
+        deadline = time.monotonic() + 5
+        while simulator.connections < 2 and time.monotonic() < deadline:
+            time.sleep(0.1)
+
+        assert simulator.connections == 2
+        assert client._connection_thread.is_alive()
+        assert client.cmd_time_request()
+
+    finally:
+        client.disconnect()
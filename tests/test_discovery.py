@@ -0,0 +1,29 @@
+"""
+Check how the discovery expands and probes its targets.
+"""
+import time
+
+from pycomfoconnect.discovery import BROADCAST, expand_targets, iter_discover
+
+
+def test_expand_targets():
+    assert list(expand_targets()) == [BROADCAST]
+    assert list(expand_targets('10.0.0.1')) == ['10.0.0.1']
+    assert list(expand_targets(['10.0.0.0/30', '10.0.0.5/32'])) == ['10.0.0.1', '10.0.0.2', '10.0.0.5']
+
+
+def test_expand_targets_once():
+    targets = ['10.0.0.1', '10.0.0.0/30', '10.0.0.2', '10.0.0.0/29', '10.0.0.0/32', 'bridge.local', 'bridge.local']
+
+    # The network and broadcast addresses of the /30 are not probed as part of it
+    assert list(expand_targets(targets)) == [
+        '10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.0.4', '10.0.0.5', '10.0.0.6', '10.0.0.0', 'bridge.local'
+    ]
+
+
+def test_discover_large_range():
+    # The probes stay on the loopback interface. Expanding the whole range up front would take seconds.
+    start = time.monotonic()
+    assert list(iter_discover(['127.0.0.0/8'], timeout=0.2, port=9)) == []
+
+    assert time.monotonic() - start < 1
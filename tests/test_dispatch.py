@@ -0,0 +1,62 @@
+"""
+Check the ordering and the overflow policies of the dispatcher.
+"""
+import threading
+import time
+
+import pytest
+
+from pycomfoconnect import Dispatcher, OVERFLOW_BLOCK, OVERFLOW_COALESCE, OVERFLOW_DROP_OLDEST
+
+
+def test_order_per_sensor():
+    dispatcher = Dispatcher(workers=4, maxsize=100000)
+    received = {}
+
+    def callback(sensor_id, value):
+        received.setdefault(sensor_id, []).append(value)
+
+    for value in range(10000):
+        dispatcher.submit(callback, value % 7, value)
+    dispatcher.close()
+
+    assert sum(len(values) for values in received.values()) == 10000
+    for values in received.values():
+        assert values == sorted(values)
+
+
+@pytest.mark.parametrize('overflow', [OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_COALESCE])
+def test_maxsize(overflow):
+    with pytest.raises(ValueError):
+        Dispatcher(maxsize=0, overflow=overflow)
+
+
+def test_close_while_blocked():
+    dispatcher = Dispatcher(workers=1, maxsize=1, overflow=OVERFLOW_BLOCK)
+    release = threading.Event()
+    received = []
+
+    def callback(sensor_id, value):
+        release.wait()
+        received.append(value)
+
+    # The worker is busy with the first update and the second one fills the queue, so the third one has to wait
+    dispatcher.submit(callback, 1, 1)
+    time.sleep(0.1)
+    dispatcher.submit(callback, 1, 2)
+    blocked = threading.Thread(target=dispatcher.submit, args=(callback, 1, 3))
+    blocked.start()
+    time.sleep(0.1)
+
+    closing = threading.Thread(target=dispatcher.close)
+    closing.start()
+    blocked.join(1)
+    assert not blocked.is_alive()
+
+    release.set()
+    closing.join(1)
+
+    # The update that was waiting when we closed is dropped instead of left behind in the queue
+    assert received == [1, 2]
+    assert dispatcher.depth == 0
+    assert dispatcher.dropped == 1